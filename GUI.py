@@ -1,29 +1,52 @@
-import queue
 import tkinter as tk
 from tkinter import ttk
 from math import pi, cos, sin
-from modID_1 import check_modID, read_input_registers
-  # Importing the data retrieval function
-import os
+from acquisition import shared_hub, send_sample, LatestValues, ExceptionReporter, METRICS_PORT, PORTS
+import metrics
+from logs import get_logger
+from modID_1 import AdaptivePoll
+from telemetry_buffer import TelemetryStore
+from sample_log import SampleLog, replay as replay_samples
+from trend_chart import TrendChart
+from relay import shared_relay
+from safety import SafetyEngine
+from timers import shared_timers, DutyCycle
 import threading
 import time
 
 
 class Gauge(tk.Canvas):
-    def __init__(self, parent, min_value=0, max_value=100, value=50, size=800, label='(V)', **kwargs):
+    """
+    Half-circle gauge. The face is drawn once; an update only moves the
+    existing needle with coords(). With animate=True the needle glides to
+    the new value over animation_frames frames, at most one frame every
+    frame_ms milliseconds.
+    """
+
+    def __init__(self, parent, min_value=0, max_value=100, value=50, size=800, label='(V)',
+                 animate=False, animation_frames=6, frame_ms=33, **kwargs):
         super(Gauge, self).__init__(parent, width=size, height=size, bg="black", **kwargs)
         self.min_value = min_value
         self.max_value = max_value
-        self.value = value
+        self.value = value  # Value the needle shows now
+        self.target = value  # Value the needle is moving to
         self.size = size
         self.radius = size // 2
         self.center = (self.radius, self.radius)
         self.arc_extent = 180  # Gauge covers half-circle
         self.label = label
+        self.animate = animate
+        self.animation_frames = animation_frames
+        self.frame_ms = frame_ms
+        self.animation = None  # Pending after() id while the needle is moving
+        self.step = 0
+        self.needle = None
+        self.needle_end = None
         self.draw_gauge()
 
     def draw_gauge(self):
         self.delete("all")  # Clear the canvas
+        self.needle = None
         start_angle = 180  # Start from left side
         end_angle = start_angle - self.arc_extent
 
@@ -41,7 +64,7 @@ class Gauge(tk.Canvas):
         tick_count = 10
         for i in range(tick_count + 1):
             angle = start_angle - (i * self.arc_extent / tick_count)
-            self.draw_tick(angle, i * (self.max_value - self.min_value) / tick_count)
+            self.draw_tick(angle, self.min_value + i * (self.max_value - self.min_value) / tick_count)
 
         # Draw the needle
         self.draw_needle()
@@ -64,237 +87,170 @@ class Gauge(tk.Canvas):
         self.create_text(text_x, text_y, text=str(int(value)), font=("Arial", 12, "bold"), fill="orange")
 
     def draw_needle(self):
-        needle_angle = 180 - self.arc_extent * ((self.value - self.min_value) / (self.max_value - self.min_value))
+        value = min(max(self.value, self.min_value), self.max_value)  # Keep the needle on the face
+        needle_angle = 180 - self.arc_extent * ((value - self.min_value) / (self.max_value - self.min_value))
         rad = pi * needle_angle / 180
         needle_length = self.radius - 40
-        x = self.center[0] + needle_length * cos(rad)
-        y = self.center[1] - needle_length * sin(rad)
-        self.create_line(self.center[0], self.center[1], x, y, fill="red", width=5)
+        x = round(self.center[0] + needle_length * cos(rad))
+        y = round(self.center[1] - needle_length * sin(rad))
+        if self.needle is None:
+            self.needle = self.create_line(self.center[0], self.center[1], x, y, fill="red", width=5)
+        elif (x, y) != self.needle_end:  # Skip the redraw if the needle would not move a pixel
+            self.coords(self.needle, self.center[0], self.center[1], x, y)
+        self.needle_end = (x, y)
 
     def update_value(self, new_value):
-        self.value = new_value
-        self.draw_gauge()
-
-
-
+        self.target = new_value
+        if not self.animate:
+            self.value = new_value
+            self.draw_needle()
+        elif self.animation is None:
+            self.step = (self.target - self.value) / self.animation_frames
+            self.animation = self.after(self.frame_ms, self.animate_needle)
+        else:
+            self.step = (self.target - self.value) / self.animation_frames  # Retarget mid-move
 
-# Create a queue for sharing data between threads
-data_queue = queue.Queue()
-# Background thread for Modbus polling
-# Background thread for Modbus polling
-def poll_modbus():
-    max_attempts = 3
-    while True:
-        modID = check_modID()  # Find a valid Modbus ID
-        attempt = 0
+    def animate_needle(self):
+        if abs(self.target - self.value) <= abs(self.step):
+            self.value = self.target
+            self.animation = None
+        else:
+            self.value += self.step
+            self.animation = self.after(self.frame_ms, self.animate_needle)
+        self.draw_needle()
 
-        while modID is not None and attempt < max_attempts:
-            try:
-                # Read input registers
-                voltage, temp, current, capacity, modID = read_input_registers(modID)
 
-                # Check if all values are None
-                if all(value is None for value in [voltage, temp, current, capacity]):
-                    attempt += 1
-                    print("Attempt {attempt}: No data received from modID {modID}. Retrying...")
-                    continue
 
-                # Put valid data into the queue for GUI updates
-                data_queue.put((voltage, temp, current, capacity, modID))
-                attempt = 0  # Reset attempts on successful data read
-                break
 
-            except Exception as e:
-                attempt += 1
-                print("Attempt {attempt}: Error reading registers from modID {modID} - {str(e)}")
+log = get_logger('GUI')
 
-        # Handle case when all attempts fail
-        if attempt >= max_attempts:
-            print("Max attempts reached for modID {modID}. Resetting modID...")
+# Newest sample per battery, shared between the poller and the Tk loop
+latest = LatestValues()
+last_update_time = None
+shown_unit = None  # (port, unit ID) of the battery on screen
+replaying = False  # Showing recorded samples rather than live ones
 
-            # Push N/A to queue for GUI update
-            data_queue.put((None, None, None, None, modID))  
+# Milliseconds between checks of the mailbox for new samples
+SAMPLE_POLL_MS = 100
 
-            # Reset modID and continuously check for a valid modID
-            while modID is None:
-                print("Attempting to find a valid Modbus ID...")
-                modID = check_modID()  # Keep checking until a valid modID is found
-                time.sleep(1)  # Small delay to avoid overloading the CPU
+# Seconds between trend chart refreshes while it is visible
+TREND_REFRESH_MS = 2000
 
-            print("Found valid modID {modID}. Attempting to read data again...")
+# Charge/discharge cycling: 3 hours on, 3 hours off, run by the one timer thread
+CYCLE_ON_SECONDS = 10800
+CYCLE_OFF_SECONDS = 10800
 
-        time.sleep(3)  # Poll every 3 seconds
+# Built by main(), so importing this module opens no window, relay or file
+root = None
+history = None  # Sample history per battery
+recorder = None  # Days of it on disk
+relay_2 = None
+safety = None
+relay_2_cycle = None  # Charge and Discharge both cycle relay 2, so they share one DutyCycle
 
 
-# GUI update function
-def update_gui():
-    global last_update_time
-    try:
-        # Check if there is new data in the queue
-        if not data_queue.empty():
-            voltage, temp, current, capacity, modID = data_queue.get_nowait()
+# The hub thread only fills the mailbox (latest.put); it never calls into Tk,
+# so a busy or hung Tk loop cannot hold up acquisition or the safety cutoffs.
+# The Tk loop checks the mailbox on a short timer instead.
+def poll_samples():
+    if latest.pending():
+        update_gui()
+    root.after(SAMPLE_POLL_MS, poll_samples)
 
-            # Update voltage
-            voltage_value.config(text="{:.2f} V".format(voltage) if voltage is not None else "N/A")
 
+# Label text currently shown, so labels are only reconfigured when it changes
+shown_text = {}
 
-            # Update temperature
-            temperature_value.config(text="{:.2f} °C".format(temp) if temp is not None else "N/A")
-            if temp is not None:
-                if temp > 45:
-                    control_relay('off')
-                
 
-            # Update current
-            current_value.config(text="{:.2f} A".format(current) if current is not None else "N/A")
+def set_text(label, text):
+    if shown_text.get(label) != text:
+        label.config(text=text)
+        shown_text[label] = text
 
-            # Update capacity
-            capacity_value.config(text="{:.2f} %".format(capacity) if capacity is not None else "N/A")
-            if capacity is not None:
-                if capacity >= 93:
-                    control_relay('off')
-                elif capacity <= 23:
-                    control_relay('off')
 
-            # Update voltage gauge
-            if voltage is not None:
-                voltage_gauge.update_value(voltage)
+def show_sample(voltage, temp, current, capacity, modID):
+    # Update voltage
+    set_text(voltage_value, "{:.2f} V".format(voltage) if voltage is not None else "N/A")
 
-            # Display modID
-            modID_value.config(text="{:.1f}".format(modID) if modID is not None else "N/A")
+    # Update temperature
+    set_text(temperature_value, "{:.2f} °C".format(temp) if temp is not None else "N/A")
 
-            # Update the timestamp of the last valid data
-            if voltage is not None or temp is not None or current is not None or capacity is not None:
-                last_update_time = time.time()
+    # Update current
+    set_text(current_value, "{:.2f} A".format(current) if current is not None else "N/A")
 
-        # Check for timeout (e.g., 15 seconds since the last valid data)
-        if last_update_time and (time.time() - last_update_time > 20):
-            print("No valid data for 15 seconds. Resetting...")
-            data_queue.put((None, None, None, None, None))  # Reset GUI to N/A
-            last_update_time = None  # Clear last update time
+    # Update capacity
+    set_text(capacity_value, "{:.2f} %".format(capacity) if capacity is not None else "N/A")
 
-    except Exception as e:
-        print("Error updating GUI:", str(e))
+    # Update voltage gauge
+    if voltage is not None:
+        voltage_gauge.update_value(voltage)
 
-    # Schedule the next GUI update
-    root.after(2000, update_gui)  # Update every second
+    # Display modID
+    set_text(modID_value, "{:.1f}".format(modID) if modID is not None else "N/A")
 
 
+# GUI update function, run when the mailbox has new data
+def update_gui():
+    global last_update_time, shown_unit
+    try:
+        updates = latest.take()
+        if updates:
+            # Render only the newest state
+            sample = max(updates.values(), key=lambda sample: sample.timestamp)
+            voltage, temp, current, capacity, modID = sample[:5]
+            show_sample(voltage, temp, current, capacity, modID)
 
+            # Update the timestamp of the last valid data
+            if voltage is not None or temp is not None or current is not None or capacity is not None:
+                last_update_time = time.time()
+                shown_unit = (sample.port, modID)
 
-# Start the Modbus polling thread
-thread = threading.Thread(target=poll_modbus, daemon=True)
-thread.start()
-
-
-
-
-def control_relay(state):
-    """
-    Control Relay 2.
-
-    :param state: 'on' to turn the relay on, 'off' to turn it off.
-    """
-    RELAY_2_PATH = "/sys/class/leds/relay-jp2/brightness"
-    if state not in ['on', 'off']:
-        raise ValueError("Invalid state. Use 'on' or 'off'.")
-
-    value = '1' if state is 'on' else '0'
-
-    try:
-        with open(RELAY_2_PATH, 'w') as relay_file:
-            relay_file.write(value)
-        print("Relay 2 turned {}.".format(state))
-    except PermissionError:
-        print("Permission denied: Please run the script with appropriate permissions.")
-    except FileNotFoundError:
-        print("File not found: {}. Ensure the RelayCape is properly connected.".format(RELAY_2_PATH))
     except Exception as e:
-        print("An error occurred: {}".format(e))
+        log.error("Error updating GUI", error=e)
 
 
+# Resets the display when data stops
+def check_gui_timeout():
+    global last_update_time
+    # Check for timeout (20 seconds since the last valid data)
+    if last_update_time and (time.time() - last_update_time > 20):
+        log.warning("No valid data, resetting the display", seconds=20)
+        show_sample(None, None, None, None, None)  # Reset GUI to N/A
+        last_update_time = None  # Clear last update time
 
+    root.after(1000, check_gui_timeout)
 
-def control_relay_1(state):
-    """
-    Control Relay 1.
 
-    :param state: 'on' to turn the relay on, 'off' to turn it off.
-    """
-    RELAY_1_PATH = "/sys/class/leds/relay-jp1/brightness"
-    if state not in ['on', 'off']:
-        raise ValueError("Invalid state. Use 'on' or 'off'.")
+# Trend view: swaps places with the details screen
+def toggle_trends():
+    if toggle_trends.visible:
+        trend_chart.grid_remove()
+        details_frame.grid()
+        trends_button.config(text="Trends")
+    else:
+        details_frame.grid_remove()
+        trend_chart.grid()
+        trends_button.config(text="Details")
+        refresh_trends(reschedule=False)
+    toggle_trends.visible = not toggle_trends.visible
 
-    value = '1' if state is 'on' else '0'
 
+def refresh_trends(reschedule=True):
     try:
-        with open(RELAY_1_PATH, 'w') as relay_file:
-            relay_file.write(value)
-        print("Relay 1 turned {}.".format(state))
-    except PermissionError:
-        print("Permission denied: Please run the script with appropriate permissions.")
-    except FileNotFoundError:
-        print("File not found: {}. Ensure the RelayCape is properly connected.".format(RELAY_1_PATH))
+        if toggle_trends.visible or not reschedule:
+            ring = history.get(*shown_unit) if shown_unit else None
+            now = None
+            if replaying and ring is not None and len(ring):
+                now = ring.last(1)['timestamp'][-1]  # Recorded time, not the clock
+            trend_chart.refresh(ring, now)
     except Exception as e:
-        print("An error occurred: {}".format(e))
-        
-
-
-
-
-
-
-
-
-root = tk.Tk()
-root.attributes("-fullscreen", True)  # Set full screen on start
-root.title("System Details")
-root.geometry("800x480")  # Set fixed size for the LCD display.
-root.configure(bg="#4a4a4a")
-style = ttk.Style()
-style.configure("TFrame", background="#4a4a4a")
-style.configure("Title.TLabel", font=("Arial", 24, "bold"), background="#4a4a4a", foreground="orange")
-style.configure("Data.TLabel", font=("Arial", 24), background="#ffffff", foreground="black", anchor="center")
-style.configure("Section.TLabel", font=("Arial", 18), background="#4a4a4a", foreground="orange")
-
-details_frame = ttk.Frame(root, style="TFrame", padding=(30, 0))
-details_frame.grid(row=0, column=0, padx=0, pady=0, sticky="nsew")
-
-details_title = ttk.Label(details_frame, text="System Details of Battery: ", style="Title.TLabel")
-details_title.grid(row=0, column=0, columnspan=3, padx=(50, 50), pady=(0, 0), sticky="n")
-
-
-modID_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
-modID_value.grid(row=0, column=1, pady=(10, 50), padx=(50, 0), sticky="w", columnspan=3)
-
+        log.error("Error updating trends", error=e)
+    if reschedule:
+        root.after(TREND_REFRESH_MS, refresh_trends)
 
 
 
-# Estimated Capacity
-capacity_label = ttk.Label(details_frame, text="Estimated Capacity %", style="Section.TLabel")
-capacity_label.grid(row=2, column=2, padx=(50, 0), pady=(30, 80))  # Adjusted position
-capacity_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
-capacity_value.grid(row=2, column=2, padx=(50, 0), pady=(40, 20))  # Adjusted position
 
-# Current
-current_label = ttk.Label(details_frame, text="Current (A)", style="Section.TLabel")
-current_label.grid(row=2, column=2, padx=(50, 0), pady=(300, 50))  # Adjusted position
-current_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
-current_value.grid(row=2, column=2, padx=(50, 0), pady=(350, 35))  # Adjusted position
-
-# Temperature
-temperature_label = ttk.Label(details_frame, text="Temperature °C", style="Section.TLabel")
-temperature_label.grid(row=2, column=2, padx=(50, 0), pady=(10, 205), sticky="n")  # Adjusted position
-temperature_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
-temperature_value.grid(row=2, column=2, padx=(50, 0), pady=(40, 375))  # Adjusted position
-
-
-# Voltage
-voltage_gauge = Gauge(details_frame, min_value=0, max_value=100, value=50, size=400, label="(V)")
-voltage_gauge.grid(row=2, column=0, padx=(280, 0), pady=(0, 0))  # Adjusted position
-
-voltage_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
-voltage_value.grid(row=2, column=0, padx=(290, 20), pady=(80, 0))  # Adjusted position
 
 
 
@@ -303,18 +259,18 @@ voltage_value.grid(row=2, column=0, padx=(290, 20), pady=(80, 0))  # Adjusted po
 def toggle_relay_charge():
     if toggle_relay_charge.is_shutdown_confirmed:
         if toggle_relay_charge.is_relay_on:
-            # Turn the relay off and stop the toggling loop
-            control_relay('off')
+            # Cancel the cycle and turn the relay off
+            relay_2_cycle.stop('off')
           #  toggle_button_discharge.config(bg="light blue", activebackground="red", text="Discharge")  # Reset to default
             toggle_button_charge.config(bg="light blue", activebackground="red", text="Charge")  # Reset to default
-            toggle_relay_charge.stop_toggling = True  # Signal to stop the loop
         else:
-            # Turn the relay on and start the toggling loop
-            control_relay('on')
+            # Turn the relay on and start cycling, taking the relay over from Discharge
+            if toggle_relay.is_relay_on:
+                toggle_button_discharge.config(bg="light blue", activebackground="red", text="Discharge")
+                toggle_relay.is_relay_on = False
+            relay_2_cycle.start()
           #  toggle_button_discharge.config(bg="red", activebackground="red", text="ACTIVE")  # Change to red when pressed
             toggle_button_charge.config(bg="red", activebackground="red", text="ACTIVE")  # Change to red when pressed
-            toggle_relay_charge.stop_toggling = False  # Allow toggling loop to start
-            start_relay_toggle_charge_thread()  # Start the background thread
 
         toggle_relay_charge.is_relay_on = not toggle_relay_charge.is_relay_on
         toggle_relay_charge.is_shutdown_confirmed = False  # Reset confirmation state
@@ -337,18 +293,18 @@ def reset_discharge_button_charge():
 def toggle_relay():
     if toggle_relay.is_shutdown_confirmed:
         if toggle_relay.is_relay_on:
-            # Turn the relay off and stop the toggling loop
-            control_relay('off')
+            # Cancel the cycle and turn the relay off
+            relay_2_cycle.stop('off')
             toggle_button_discharge.config(bg="light blue", activebackground="red", text="Discharge")  # Reset to default
          #   toggle_button_charge.config(bg="light blue", activebackground="red", text="Charge")  # Reset to default
-            toggle_relay.stop_toggling = True  # Signal to stop the loop
         else:
-            # Turn the relay on and start the toggling loop
-            control_relay('on')
+            # Turn the relay on and start cycling, taking the relay over from Charge
+            if toggle_relay_charge.is_relay_on:
+                toggle_button_charge.config(bg="light blue", activebackground="red", text="Charge")
+                toggle_relay_charge.is_relay_on = False
+            relay_2_cycle.start()
             toggle_button_discharge.config(bg="red", activebackground="red", text="ACTIVE")  # Change to red when pressed
           #  toggle_button_charge.config(bg="red", activebackground="red", text="ACTIVE")  # Change to red when pressed
-            toggle_relay.stop_toggling = False  # Allow toggling loop to start
-            start_relay_toggle_thread()  # Start the background thread
 
         toggle_relay.is_relay_on = not toggle_relay.is_relay_on
         toggle_relay.is_shutdown_confirmed = False  # Reset confirmation state
@@ -367,91 +323,177 @@ def reset_discharge_button():
         toggle_relay.is_shutdown_confirmed = False
 
 
-def toggle_relay_charge_loop():
-    while not toggle_relay_charge.stop_toggling:  # Continue looping until stop_toggling is True
-        control_relay('on')
-        print("Relay ON")  # Debugging print
-        time.sleep(10800)  # Wait for 5 mins
-        if toggle_relay_charge.stop_toggling:  # Check if the loop should stop
-            break
-        control_relay('off')
-        print("Relay OFF")  # Debugging print
-        time.sleep(10800)  # Wait for 5 mins
-
-def start_relay_toggle_charge_thread():
-    # Start a background thread to handle the toggling loop
-    thread = threading.Thread(target=toggle_relay_charge_loop)
-    thread.daemon = True  # Ensure the thread exits when the main program exits
-    thread.start()
-
-def toggle_relay_loop():
-    while not toggle_relay.stop_toggling:  # Continue looping until stop_toggling is True
-        control_relay('on')
-        print("Relay ON")  # Debugging print
-        time.sleep(10800)  # Wait for 5 mins
-        if toggle_relay.stop_toggling:  # Check if the loop should stop
-            break
-        control_relay('off')
-        print("Relay OFF")  # Debugging print
-        time.sleep(10800)  # Wait for 5 mins
-
-def start_relay_toggle_thread():
-    # Start a background thread to handle the toggling loop
-    thread = threading.Thread(target=toggle_relay_loop)
-    thread.daemon = True  # Ensure the thread exits when the main program exits
-    thread.start()
-
 # Initialize variables
 toggle_relay.is_relay_on = False
-toggle_relay.stop_toggling = True
 toggle_relay.is_shutdown_confirmed = False
 
 toggle_relay_charge.is_relay_on = False
-toggle_relay_charge.stop_toggling = True
 toggle_relay_charge.is_shutdown_confirmed = False
 
 
+def build_window():
+    """
+    Create the full-screen window and its widgets.
+    """
+    global root, details_frame, modID_value, capacity_value, current_value, temperature_value
+    global voltage_gauge, voltage_value, trend_chart, trends_button, toggle_button_charge, toggle_button_discharge
+    root = tk.Tk()
+    root.attributes("-fullscreen", True)  # Set full screen on start
+    root.title("System Details")
+    root.geometry("800x480")  # Set fixed size for the LCD display.
+    root.configure(bg="#4a4a4a")
+    style = ttk.Style()
+    style.configure("TFrame", background="#4a4a4a")
+    style.configure("Title.TLabel", font=("Arial", 24, "bold"), background="#4a4a4a", foreground="orange")
+    style.configure("Data.TLabel", font=("Arial", 24), background="#ffffff", foreground="black", anchor="center")
+    style.configure("Section.TLabel", font=("Arial", 18), background="#4a4a4a", foreground="orange")
+
+    details_frame = ttk.Frame(root, style="TFrame", padding=(30, 0))
+    details_frame.grid(row=0, column=0, padx=0, pady=0, sticky="nsew")
+
+    details_title = ttk.Label(details_frame, text="System Details of Battery: ", style="Title.TLabel")
+    details_title.grid(row=0, column=0, columnspan=3, padx=(50, 50), pady=(0, 0), sticky="n")
+
+
+    modID_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
+    modID_value.grid(row=0, column=1, pady=(10, 50), padx=(50, 0), sticky="w", columnspan=3)
+
+
+
+
+    # Estimated Capacity
+    capacity_label = ttk.Label(details_frame, text="Estimated Capacity %", style="Section.TLabel")
+    capacity_label.grid(row=2, column=2, padx=(50, 0), pady=(30, 80))  # Adjusted position
+    capacity_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
+    capacity_value.grid(row=2, column=2, padx=(50, 0), pady=(40, 20))  # Adjusted position
+
+    # Current
+    current_label = ttk.Label(details_frame, text="Current (A)", style="Section.TLabel")
+    current_label.grid(row=2, column=2, padx=(50, 0), pady=(300, 50))  # Adjusted position
+    current_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
+    current_value.grid(row=2, column=2, padx=(50, 0), pady=(350, 35))  # Adjusted position
+
+    # Temperature
+    temperature_label = ttk.Label(details_frame, text="Temperature °C", style="Section.TLabel")
+    temperature_label.grid(row=2, column=2, padx=(50, 0), pady=(10, 205), sticky="n")  # Adjusted position
+    temperature_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
+    temperature_value.grid(row=2, column=2, padx=(50, 0), pady=(40, 375))  # Adjusted position
+
+
+    # Voltage
+    voltage_gauge = Gauge(details_frame, min_value=0, max_value=100, value=50, size=400, label="(V)")
+    voltage_gauge.grid(row=2, column=0, padx=(280, 0), pady=(0, 0))  # Adjusted position
+
+    voltage_value = ttk.Label(details_frame, text="N/A", style="Data.TLabel", width=12)
+    voltage_value.grid(row=2, column=0, padx=(290, 20), pady=(80, 0))  # Adjusted position
+
+    # Trends of the battery on screen, shown in place of the details
+    trend_chart = TrendChart(root, width=740, height=320)
+    trend_chart.grid(row=0, column=0, padx=30, pady=(20, 0))
+    trend_chart.grid_remove()
+    toggle_trends.visible = False
+
+    trends_button = tk.Button(
+        root,
+        text="Trends",
+        command=toggle_trends,
+        font=("Arial", 16, "bold"),
+        bg="light blue",
+        fg="black",
+        activebackground="orange",
+        width=8,
+    )
+    trends_button.grid(row=0, column=0, padx=(0, 10), pady=(10, 0), sticky="ne")
+
+
+    # Create charge button
+    toggle_button_charge = tk.Button(
+        root,
+        text="Charge",
+        command=toggle_relay_charge,
+        font=("Arial", 20, "bold"),  # Larger font size
+        bg="light blue",  # Default background color
+        fg="black",  # Default text color
+        activebackground="red",  # Color when pressed
+        activeforeground="white",  # Text color when pressed
+        width=18,  # Adjust button width
+        height=2  # Adjust button height
+    )
+    toggle_button_charge.grid(row=4, column=0, padx=(325, 0), pady=(5, 50))  # Moved down and spaced apart
+
+
+
+
+
+
+    # Create discharge button
+    toggle_button_discharge = tk.Button(
+        root,
+        text="Discharge",
+        command=toggle_relay,
+        font=("Arial", 20, "bold"),  # Larger font size
+        bg="light blue",  # Default background color
+        fg="black",  # Default text color
+        activebackground="red",  # Color when pressed
+        activeforeground="white",  # Text color when pressed
+        width=18,  # Adjust button width
+        height=2  # Adjust button height
+    )
+    toggle_button_discharge.grid(row=4, column=0, padx=(97, 680), pady=(5, 50))  # Moved down and spaced apart
 
-# Create charge button
-toggle_button_charge = tk.Button(
-    root,
-    text="Charge",
-    command=toggle_relay_charge,
-    font=("Arial", 20, "bold"),  # Larger font size
-    bg="light blue",  # Default background color
-    fg="black",  # Default text color
-    activebackground="red",  # Color when pressed
-    activeforeground="white",  # Text color when pressed
-    width=18,  # Adjust button width
-    height=2  # Adjust button height
-)
-toggle_button_charge.grid(row=4, column=0, padx=(325, 0), pady=(5, 50))  # Moved down and spaced apart
-
-
-
-
-
-
-# Create discharge button
-toggle_button_discharge = tk.Button(
-    root,
-    text="Discharge",
-    command=toggle_relay,
-    font=("Arial", 20, "bold"),  # Larger font size
-    bg="light blue",  # Default background color
-    fg="black",  # Default text color
-    activebackground="red",  # Color when pressed
-    activeforeground="white",  # Text color when pressed
-    width=18,  # Adjust button width
-    height=2  # Adjust button height
-)
-toggle_button_discharge.grid(row=4, column=0, padx=(97, 680), pady=(5, 50))  # Moved down and spaced apart
+    # Add a timer to reset the button state after 5 seconds if not confirmed
+    root.after(2000, reset_discharge_button)
 
-# Add a timer to reset the button state after 5 seconds if not confirmed
-root.after(2000, reset_discharge_button)
 
+def main(ports=PORTS, metrics_port=METRICS_PORT, replay=None, speed=1.0):
+    """
+    Build the window, start acquisition and run the Tk loop until it is closed.
 
+    With replay=(start, end) the recorded samples of that range are shown
+    instead, at speed times their original pace, and the serial buses are
+    left alone. Replayed samples go to the display and trends only: they
+    do not drive the safety cutoffs, are not recorded again and are not sent.
+    """
+    global history, recorder, relay_2, safety, relay_2_cycle, replaying
+    # Sample history per battery (one day at 1 Hz), and days of it on disk
+    history = TelemetryStore(capacity=86400)
+    recorder = SampleLog()
+
+    # Relay 2 switches the charge/discharge circuit; writes only happen on a state change
+    relay_2 = shared_relay(2)
+
+    # Temperature and capacity cutoffs, evaluated on the acquisition thread
+    safety = SafetyEngine()
+
+    # An on phase leaves the relay off while a cutoff holds it (see Relay.hold)
+    relay_2_cycle = DutyCycle(shared_timers(), relay_2, CYCLE_ON_SECONDS, CYCLE_OFF_SECONDS)
+
+    build_window()
+
+    # One hub owns the serial buses; the display, safety cutoffs and network sender all subscribe to it
+    # Poll every 3 seconds, faster near a cutoff or while values move fast, slower when idle
+    hub = shared_hub(ports, scheduler_options={'period': 3, 'adaptive': AdaptivePoll()})
+    replaying = replay is not None
+    if not replaying:
+        hub.subscribe(safety)  # First, so a cutoff waits on nothing else
+    hub.subscribe(latest.put)
+    hub.subscribe(history.add)
+    if not replaying:
+        hub.subscribe(recorder.append)
+        hub.subscribe(ExceptionReporter(send_sample))  # Only changes and a heartbeat go to the network
+
+    root.after(SAMPLE_POLL_MS, poll_samples)
+    root.after(1000, check_gui_timeout)
+    root.after(TREND_REFRESH_MS, refresh_trends)
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    if replaying:
+        threading.Thread(target=replay_samples, args=(recorder.samples(*replay), hub.publish, speed),
+                         name="replay", daemon=True).start()
+    else:
+        hub.start()
+    root.mainloop()
 
 
-root.after(3000, update_gui)
-root.mainloop()
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,344 @@
+import collections
+import ipaddress
+import selectors
 import socket
+import threading
+import time
+import metrics
+from logs import get_logger
+from wire_format import FRAME_VERSION, frame, decode_frame, sequence_gap
 
-def start_tcp_server():
-    # Create a TCP/IP socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Address the battery senders connect to
+HOST = ''
+PORT = 12345
 
-    # Bind the socket to the port
-    server_address = ('', 12345)
-    server_socket.bind(server_address)
+# A line longer than this without a newline is garbage and is discarded
+MAX_LINE = 4096
 
-    # Listen for incoming connections
-    server_socket.listen(1)
-    print("Server is listening on port 12345...")
+# UDP targets for OpenRVDAS: broadcast ('<broadcast>'), a multicast group or unicast hosts
+UDP_TARGETS = [('<broadcast>', 65534)]
+MULTICAST_TTL = 1
+UDP_BATCH_INTERVAL = 0  # Seconds to gather records into one datagram, 0 sends each at once
+MAX_DATAGRAM = 1400  # Stay under a typical Ethernet MTU
 
-    while True:
-        # Wait for a connection
-        connection, client_address = server_socket.accept()
+# Local HTTP port of the Prometheus metrics endpoint
+METRICS_PORT = 9109
+
+log = get_logger('Socket_server')
+
+# Field name -> type for the "voltage=..., temp=..., current=..., capacity=..., modID=..." lines
+FIELD_TYPES = {
+    b'voltage': float,
+    b'temp': float,
+    b'current': float,
+    b'capacity': float,
+    b'modID': int,
+}
+
+
+def parse_record(line):
+    """
+    Parse one line from modID_1.send_data into a dict, e.g.
+    b'voltage=52, temp=25, current=-1, capacity=58, modID=2' ->
+    {'voltage': 52.0, 'temp': 25.0, 'current': -1.0, 'capacity': 58.0, 'modID': 2}.
+    Returns None if the line is malformed.
+    """
+    record = {}
+    try:
+        for field in line.split(b','):
+            name, _, value = field.strip().partition(b'=')
+            convert = FIELD_TYPES.get(name)
+            if convert is None:
+                record[name.decode()] = value.decode()
+            else:
+                record[name.decode()] = convert(value)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return record if record.keys() >= {'voltage', 'modID'} else None
+
+
+def format_record(record):
+    """
+    Format a parsed record as a text line for the UDP consumers.
+    """
+    return ", ".join("{}={}".format(name, value) for name, value in record.items()) + "\n"
+
+
+def is_multicast(host):
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:  # '<broadcast>' or a host name
+        return False
+
+
+class UdpRelay(object):
+    """
+    Forwards parsed records to the UDP targets from one pre-bound socket.
+
+    submit() only appends to a bounded deque (the oldest record is dropped
+    when it is full), so the TCP ingest loop never waits on fan-out. A relay
+    thread formats the records and sends them without blocking; a datagram
+    the kernel will not take right now is dropped and counted. With a batch
+    interval, records gathered during the interval are packed into as few
+    datagrams of at most MAX_DATAGRAM bytes as possible.
+    """
+
+    def __init__(self, targets=UDP_TARGETS, batch_interval=UDP_BATCH_INTERVAL,
+                 maxlen=10000, ttl=MULTICAST_TTL):
+        self.targets = list(targets)
+        self.batch_interval = batch_interval
+        self.pending = collections.deque(maxlen=maxlen)
+        self.ready = threading.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.thread = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if any(is_multicast(host) for host, port in self.targets):
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.bind(('', 0))
+        self.sock.setblocking(False)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="udp relay", daemon=True)
+            self.thread.start()
+        return self
+
+    def submit(self, record, client_address=None):
+        """
+        Queue one parsed record for fan-out. Never blocks.
+        """
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(record)
+        self.ready.set()
+
+    def datagrams(self, lines):
+        """
+        Pack encoded lines into datagrams of at most MAX_DATAGRAM bytes.
+        """
+        datagram = b''
+        for line in lines:
+            if datagram and len(datagram) + len(line) > MAX_DATAGRAM:
+                yield datagram
+                datagram = b''
+            datagram += line
+        if datagram:
+            yield datagram
+
+    def send(self, datagram):
+        for target in self.targets:
+            try:
+                self.sock.sendto(datagram, target)
+                self.sent += 1
+            except (BlockingIOError, InterruptedError):
+                self.dropped += 1
+            except OSError as e:
+                self.dropped += 1
+                log.warning("UDP send failed", target=target, error=e)
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            if self.batch_interval:
+                time.sleep(self.batch_interval)
+            self.ready.clear()
+            lines = []
+            while self.pending:
+                lines.append(format_record(self.pending.popleft()).encode())
+            if self.batch_interval:
+                for datagram in self.datagrams(lines):
+                    self.send(datagram)
+            else:
+                for line in lines:
+                    self.send(line)
+
+
+class Connection(object):
+    """
+    One sender's connection and the bytes received after its last complete line.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+
+
+class TelemetryServer(object):
+    """
+    Event-driven TCP server that takes many battery connections at once.
+
+    A single selector loop accepts connections and reads whichever sockets
+    are ready into one reusable receive buffer. Each connection's stream is
+    split on newlines, so a line split across reads, or several lines in one
+    read, are handled correctly. Binary frames (wire_format.py) may be mixed
+    in; their sequence numbers are tracked per sender and unit ID, and the
+    gaps are counted in lost. Every parsed record is passed to on_record.
+    """
+
+    def __init__(self, host=HOST, port=PORT, on_record=None, backlog=128, recv_size=65536):
+        self.on_record = on_record or print_record
+        self.selector = selectors.DefaultSelector()
+        self.recv_buffer = bytearray(recv_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.records = 0
+        self.malformed = 0
+        self.lost = 0  # Binary frames missing from sequence gaps
+        self.last_seq = {}  # (sender host, modID) -> last sequence number seen
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.address = self.server_socket.getsockname()
+
+    def accept(self):
         try:
-            print(f"Connection from {client_address}")
-
-            # Receive the data in small chunks and print it
-            while True:
-                data = connection.recv(1024)
-                if data:
-                    # Assume data is received in the form of a dictionary
-                    data_dict = eval(data.decode())
-                    print(f"Received data: {data_dict}")
-                else:
+            sock, address = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        log.info("Connection", address=address)
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, Connection(sock, address))
+
+    def close_connection(self, connection):
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+
+    def read(self, connection):
+        try:
+            size = connection.sock.recv_into(self.recv_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.warning("Connection failed", address=connection.address, error=e)
+            size = 0
+        if not size:
+            self.close_connection(connection)
+            return
+
+        buffer = connection.buffer
+        buffer += self.recv_view[:size]
+        if FRAME_VERSION in buffer:
+            used = self.read_mixed(connection)
+        else:
+            used = self.read_lines(connection)
+        if len(buffer) - used > MAX_LINE:
+            log.warning("Discarding bytes without a newline", bytes=len(buffer) - used, address=connection.address)
+            used = len(buffer)
+        del buffer[:used]
+
+    def read_lines(self, connection):
+        """
+        Fast path for text only: handle every complete line in the buffer.
+        Returns the number of bytes used.
+        """
+        buffer = connection.buffer
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            return 0
+        for line in bytes(buffer[:end]).split(b'\n'):
+            if line.strip():
+                self.handle(parse_record(line), connection)
+        return end + 1
+
+    def read_mixed(self, connection):
+        """
+        Handle a buffer holding binary frames, possibly between text lines.
+        Returns the number of bytes used.
+        """
+        buffer = connection.buffer
+        pos = 0
+        while pos < len(buffer):
+            if buffer[pos] == FRAME_VERSION:
+                if len(buffer) - pos < frame.size:
+                    break
+                record = decode_frame(buffer, pos)
+                pos += frame.size
+                key = (connection.address[0], record['modID'])
+                if key in self.last_seq:
+                    self.lost += sequence_gap(self.last_seq[key], record['seq'])
+                self.last_seq[key] = record['seq']
+                self.handle(record, connection)
+            else:
+                end = buffer.find(b'\n', pos)
+                if end < 0:
                     break
-        finally:
-            # Clean up the connection
-            connection.close()
+                line = bytes(buffer[pos:end])
+                pos = end + 1
+                if line.strip():
+                    self.handle(parse_record(line), connection)
+        return pos
+
+    def handle(self, record, connection):
+        if record is None:
+            self.malformed += 1
+            return
+        self.records += 1
+        self.on_record(record, connection.address)
+
+    def poll(self, timeout=None):
+        """
+        Handle every socket that becomes ready within timeout seconds.
+        """
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self.accept()
+            else:
+                self.read(key.data)
+
+    def serve_forever(self):
+        log.info("Server is listening", port=self.address[1])
+        while True:
+            self.poll()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def print_record(record, client_address):
+    log.info("Received data", **record)
+
+
+def start_tcp_server(udp_targets=UDP_TARGETS, batch_interval=UDP_BATCH_INTERVAL, host=HOST, port=PORT,
+                     metrics_port=METRICS_PORT):
+    """
+    Receive battery telemetry over TCP and relay each record to OpenRVDAS over UDP.
+    """
+    relay = UdpRelay(udp_targets, batch_interval).start()
+    server = TelemetryServer(host, port, on_record=relay.submit)
+    register_metrics(server, relay)
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    server.serve_forever()
+
+
+def register_metrics(server, relay):
+    """
+    Expose the counters the server and relay keep anyway; they are read at
+    scrape time, so ingest pays nothing for them.
+    """
+    metrics.counter('telemetry_server_records_total', "Records received.").set_function(lambda: server.records)
+    metrics.counter('telemetry_server_malformed_total', "Lines that could not be parsed.").set_function(
+        lambda: server.malformed)
+    metrics.counter('telemetry_server_lost_frames_total', "Binary frames missing from sequence gaps.").set_function(
+        lambda: server.lost)
+    metrics.gauge('telemetry_server_connections', "Open sender connections.").set_function(
+        lambda: len(server.selector.get_map()) - 1)
+    metrics.counter('udp_relay_datagrams_sent_total', "Datagrams sent to the UDP targets.").set_function(
+        lambda: relay.sent)
+    metrics.counter('udp_relay_dropped_total', "Records or datagrams the relay dropped.").set_function(
+        lambda: relay.dropped)
+    metrics.gauge('udp_relay_queue_depth', "Records waiting for the relay thread.").set_function(
+        lambda: len(relay.pending))
+
 
 if __name__ == "__main__":
     start_tcp_server()
@@ -0,0 +1,395 @@
+import glob
+import queue
+import sys
+import threading
+import time
+import metrics
+from logs import get_logger
+from modID_1 import ModbusSession, UnitScheduler, AdaptivePoll, Sample, send_data
+from sample_log import SampleLog
+from safety import SafetyEngine
+from timers import shared_timers
+
+# Serial ports to poll. Entries may be globs, e.g. '/dev/ttyUSB*' for every adapter.
+PORTS = ['/dev/ttyUSB*']
+
+# Report by exception: a sample goes to the network when a field moved at
+# least its deadband since the last report, or HEARTBEAT seconds have passed
+DEADBANDS = {'voltage': 0.1, 'temp': 0.5, 'current': 0.2, 'capacity': 0.5}
+HEARTBEAT = 60
+
+# Seconds between scans of the port globs for newly plugged adapters
+RESCAN_INTERVAL = 30
+
+# Local HTTP port of the Prometheus metrics endpoint
+METRICS_PORT = 9108
+
+# Seconds from start-up to the first sample before a warning is logged
+STARTUP_BUDGET = 10.0
+
+log = get_logger('acquisition')
+
+
+def expand_ports(ports):
+    """
+    Turn a list of serial ports and globs (or a single string) into a sorted
+    list of unique device paths. A glob that matches nothing is skipped.
+    """
+    if isinstance(ports, str):
+        ports = [ports]
+    found = []
+    for port in ports:
+        if glob.has_magic(port):
+            matches = sorted(glob.glob(port))
+        else:
+            matches = [port]
+        for match in matches:
+            if match not in found:
+                found.append(match)
+    return found
+
+
+class BusWorker(threading.Thread):
+    """
+    Polls one serial bus: its own Modbus session, discovery loop and unit
+    scheduler. Every sample is put on the shared samples queue, tagged with
+    the port it came from.
+    """
+
+    def __init__(self, port, samples, session_options=None, scheduler_options=None):
+        """
+        :param samples: queue.Queue shared by all workers.
+        :param session_options: extra ModbusSession arguments (parity, bytesize, timeout...).
+        :param scheduler_options: extra UnitScheduler arguments (unit_ids, period...).
+        """
+        super(BusWorker, self).__init__(name="bus {}".format(port), daemon=True)
+        self.port = port
+        self.samples = samples
+        self.session = ModbusSession(port=port, **(session_options or {}))
+        self.scheduler = UnitScheduler(session=self.session, on_samples=self.publish,
+                                       on_lost=self.publish_lost, **(scheduler_options or {}))
+        self.stopped = threading.Event()
+
+    def publish(self, samples):
+        for sample in samples:
+            self.samples.put(sample)
+
+    def publish_lost(self, modID):
+        # An all-None sample tells consumers the unit went away (GUI shows N/A)
+        self.samples.put(Sample(None, None, None, None, modID, time.time(), self.port))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scheduler.run_once()
+            except Exception as e:
+                log.error("Error polling", port=self.port, error=e)
+                time.sleep(1)  # Small delay to avoid overloading the CPU
+        self.session.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class MultiBusAcquisition(object):
+    """
+    Runs one BusWorker per serial port, all feeding one sample stream.
+    Each bus has its own 115200-baud line, so throughput grows with the
+    number of adapters.
+    """
+
+    def __init__(self, ports=PORTS, session_options=None, scheduler_options=None):
+        self.ports = ports
+        self.session_options = session_options
+        self.scheduler_options = scheduler_options
+        self.samples = queue.Queue()
+        self.workers = {}  # port -> BusWorker
+        self.lock = threading.Lock()  # start() also runs on the timer thread
+        metrics.gauge('bms_acquisition_queue_depth', "Samples waiting for the hub.").set_function(
+            self.samples.qsize)
+
+    def start(self):
+        """
+        Start a worker for every port not yet being polled. Calling it again
+        picks up adapters plugged in since the last call.
+        """
+        with self.lock:
+            for port in expand_ports(self.ports):
+                if port not in self.workers:
+                    log.info("Starting acquisition", port=port)
+                    worker = BusWorker(port, self.samples, self.session_options, self.scheduler_options)
+                    self.workers[port] = worker
+                    worker.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            workers = list(self.workers.values())
+            self.workers.clear()
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+
+    def get(self, timeout=None):
+        """
+        Return the next sample from any bus, or None after timeout seconds.
+        """
+        try:
+            return self.samples.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class QueuedSubscriber(object):
+    """
+    Runs a slow subscriber on its own thread behind a bounded queue, so it
+    cannot hold up the hub or the other subscribers. When the queue is full
+    the oldest sample is dropped.
+    """
+
+    def __init__(self, callback, maxsize=100):
+        self.callback = callback
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.name = getattr(callback, '__name__', type(callback).__name__)
+        metrics.gauge('bms_subscriber_queue_depth', "Samples waiting for a subscriber thread.",
+                      ['subscriber']).labels(self.name).set_function(self.queue.qsize)
+        metrics.counter('bms_subscriber_dropped_total', "Samples a slow subscriber missed.",
+                        ['subscriber']).labels(self.name).set_function(lambda: self.dropped)
+        self.thread = threading.Thread(target=self.run, name="subscriber", daemon=True)
+        self.thread.start()
+
+    def __call__(self, sample):
+        while True:
+            try:
+                self.queue.put_nowait(sample)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            sample = self.queue.get()
+            try:
+                self.callback(sample)
+            except Exception as e:
+                log.error("Subscriber error", subscriber=self.name, error=e)
+
+
+class LatestValues(object):
+    """
+    Latest-value mailbox: one slot per unit ID that always holds the newest
+    sample, so a slow reader renders the current state instead of working
+    through a backlog. The hub thread put()s every sample; the GUI checks
+    pending() every 100 ms on the Tk loop (GUI.SAMPLE_POLL_MS) and take()s
+    the slots when something new has come, so however fast samples arrive
+    the display refreshes at most once per check.
+    """
+
+    def __init__(self):
+        self.slots = {}  # modID -> newest Sample not yet taken
+        self.lock = threading.Lock()
+
+    def put(self, sample):
+        with self.lock:
+            self.slots[sample[4]] = sample
+
+    def pending(self):
+        return bool(self.slots)
+
+    def take(self):
+        """
+        Return and clear the dict of modID -> newest Sample posted since the last take().
+        """
+        with self.lock:
+            slots = self.slots
+            self.slots = {}
+        return slots
+
+
+class AcquisitionHub(object):
+    """
+    The one owner of the serial buses in a process. Every decoded sample is
+    published to all subscribers (GUI, network sender, relay safety logic),
+    so adding a consumer adds nothing on the wire.
+
+    Subscribers are called on the hub thread and must return quickly; pass
+    own_thread=True for anything that can block, such as network I/O.
+    """
+
+    def __init__(self, ports=PORTS, session_options=None, scheduler_options=None,
+                 rescan_interval=RESCAN_INTERVAL):
+        self.acquisition = MultiBusAcquisition(ports, session_options, scheduler_options)
+        self.rescan_interval = rescan_interval
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, callback, own_thread=False, maxsize=100):
+        """
+        Register callback(sample). Returns the handle to pass to unsubscribe().
+        """
+        if own_thread:
+            callback = QueuedSubscriber(callback, maxsize)
+        with self.lock:
+            # Copy on write so the hub thread never iterates a list being changed
+            self.subscribers = self.subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, handle):
+        with self.lock:
+            self.subscribers = [callback for callback in self.subscribers if callback is not handle]
+
+    def publish(self, sample):
+        for callback in self.subscribers:
+            try:
+                callback(sample)
+            except Exception as e:
+                log.error("Subscriber error", subscriber=getattr(callback, '__name__', type(callback).__name__),
+                          error=e)
+
+    def start(self):
+        """
+        Start polling. Subscribe first so the earliest samples are not missed.
+        Calling it again does nothing.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.acquisition.start()
+                self.thread = threading.Thread(target=self.run, name="acquisition hub", daemon=True)
+                self.thread.start()
+                if self.rescan_interval:
+                    shared_timers().schedule(self.rescan_interval, self.rescan)
+                log.info("System initialized, monitoring Modbus devices")
+        return self
+
+    def rescan(self):
+        """
+        Look for newly plugged adapters every rescan_interval seconds,
+        whether or not the other buses are delivering samples.
+        """
+        try:
+            self.acquisition.start()
+        finally:
+            shared_timers().schedule(self.rescan_interval, self.rescan)
+
+    def run(self):
+        while True:
+            sample = self.acquisition.get()
+            self.publish(sample)
+
+
+# Process-wide hub, created by shared_hub()
+hub = None
+hub_lock = threading.Lock()
+
+
+def shared_hub(ports=PORTS, **options):
+    """
+    Return the process-wide AcquisitionHub, creating it on the first call.
+    Later calls ignore their arguments. The caller starts it.
+    """
+    global hub
+    with hub_lock:
+        if hub is None:
+            hub = AcquisitionHub(ports, **options)
+        return hub
+
+
+def send_sample(sample):
+    """
+    Queue one complete sample for the network. Does not block.
+    """
+    voltage, temp, current, capacity, modID, timestamp = sample[:6]
+    if None not in (voltage, temp, current, capacity):
+        send_data(voltage, temp, current, capacity, modID, timestamp)  # Send data via TCP
+
+
+class ExceptionReporter(object):
+    """
+    Hub subscriber that passes a sample on to report(sample) only when it
+    is news: some field moved by at least its deadband (or appeared or went
+    missing) since the unit's last report, or heartbeat seconds passed.
+    Counts reported and suppressed samples.
+    """
+
+    def __init__(self, report, deadbands=DEADBANDS, heartbeat=HEARTBEAT):
+        self.report = report
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        self.last = {}  # (port, modID) -> (last reported Sample, monotonic time)
+        self.reported = 0
+        self.suppressed = 0
+
+    def changed(self, sample, reported):
+        for name, deadband in self.deadbands.items():
+            value, before = getattr(sample, name), getattr(reported, name)
+            if (value is None) != (before is None):
+                return True
+            if value is not None and abs(value - before) >= deadband:
+                return True
+        return False
+
+    def __call__(self, sample):
+        key = (sample.port, sample.modID)
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None and now - last[1] < self.heartbeat and not self.changed(sample, last[0]):
+            self.suppressed += 1
+            return
+        self.last[key] = (sample, now)
+        self.reported += 1
+        self.report(sample)
+
+
+class StartupClock(object):
+    """
+    Hub subscriber that measures start-up: the seconds from started (a
+    time.monotonic() value, now by default) to the first sample with data.
+    The time is logged once and exported as bms_startup_seconds; if no
+    sample has come after budget seconds a warning is logged instead.
+    """
+
+    def __init__(self, started=None, budget=STARTUP_BUDGET):
+        self.started = time.monotonic() if started is None else started
+        self.budget = budget
+        self.seconds = None
+        self.gauge = metrics.gauge('bms_startup_seconds', "Seconds from start-up to the first sample.")
+        shared_timers().schedule(max(0.0, self.started + budget - time.monotonic()), self.overdue)
+
+    def __call__(self, sample):
+        if self.seconds is None and any(value is not None for value in sample[:4]):
+            self.seconds = time.monotonic() - self.started
+            self.gauge.set(self.seconds)
+            log.info("First sample", seconds=round(self.seconds, 3), modID=sample.modID, port=sample.port)
+
+    def overdue(self):
+        if self.seconds is None:
+            log.warning("No sample within the start-up budget", budget=self.budget)
+
+
+def monitor_modbus(ports=PORTS, metrics_port=METRICS_PORT, started=None):
+    """
+    Headless acquisition: poll every battery on every bus, apply the relay
+    safety cutoffs, record each sample on disk and send each complete sample
+    to the network. started is when the process started, for StartupClock.
+    """
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    hub = shared_hub(ports, scheduler_options={'adaptive': AdaptivePoll()})
+    hub.subscribe(SafetyEngine())
+    hub.subscribe(StartupClock(started))
+    hub.subscribe(SampleLog().append)
+    hub.subscribe(ExceptionReporter(send_sample))
+    hub.start()
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    monitor_modbus(sys.argv[1:] or PORTS)
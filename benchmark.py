@@ -0,0 +1,145 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import modID_1
+from modID_1 import ModbusSession, UnitScheduler, read_input_registers, UNIT_IDS
+from bms_simulator import BmsSimulator
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Nearest-rank percentiles of values in milliseconds, plus the maximum.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = dict(('p{}'.format(point), round(1000 * ordered[max(0, -(-len(ordered) * point // 100) - 1)], 3))
+                  for point in points)
+    result['max'] = round(1000 * ordered[-1], 3)
+    return result
+
+
+def session_for(simulator, timeout):
+    # Pseudo-terminals do not take 7-bit framing
+    return ModbusSession(simulator.port, parity='N', bytesize=8, timeout=timeout)
+
+
+def bench_poll(unit_ids, rounds, latency, timeout, garble_rate=0.0):
+    """
+    Poll every unit rounds times through the UnitScheduler as fast as it
+    goes. Reports the latency of one poll cycle (every unit once), the
+    samples per second and how many samples had every field.
+    """
+    simulator = BmsSimulator(unit_ids, latency=latency, garble_rate=garble_rate, seed=1)
+    session = session_for(simulator, timeout)
+    try:
+        scheduler = UnitScheduler(unit_ids, period=0, session=session, stale_after=3600)
+        scheduler.run_once()  # Discovery up to the first unit
+        scheduler.run_once()  # and the rest of the range
+        cycles = []
+        samples = complete = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            begin = time.perf_counter()
+            produced = scheduler.run_once()
+            cycles.append(time.perf_counter() - begin)
+            samples += len(produced)
+            complete += sum(1 for sample in produced if None not in sample[:4])
+        elapsed = time.perf_counter() - start
+        return {
+            'units': len(scheduler.due),
+            'cycles': rounds,
+            'cycle_ms': percentiles(cycles),
+            'samples': samples,
+            'samples_per_second': round(samples / elapsed, 1),
+            'complete_samples': complete,
+            'expected_samples': rounds * len(unit_ids),
+            'garbled_frames': simulator.garbled,
+        }
+    finally:
+        session.close()
+        simulator.close()
+
+
+def bench_discovery(timeout, latency):
+    """
+    Time check_modID() when only the last unit ID answers, its slowest case.
+    """
+    simulator = BmsSimulator([UNIT_IDS[-1]], latency=latency)
+    session = session_for(simulator, timeout)
+    default_session = modID_1.bus_session
+    modID_1.bus_session = session  # check_modID() always uses the default session
+    try:
+        start = time.perf_counter()
+        found = modID_1.check_modID()
+        return {'found': found, 'seconds': round(time.perf_counter() - start, 3)}
+    finally:
+        modID_1.bus_session = default_session
+        session.close()
+        simulator.close()
+
+
+def bench_recovery(fault_seconds, timeout, latency, limit=120):
+    """
+    Silence the bus for fault_seconds while polling, then time how long
+    after the fault ends the first good sample arrives.
+    """
+    simulator = BmsSimulator([1], latency=latency)
+    session = session_for(simulator, timeout)
+    try:
+        for _ in range(3):
+            read_input_registers(1, session)
+        simulator.silence(fault_seconds)
+        fault_end = time.monotonic() + fault_seconds
+        failed_polls = 0
+        while time.monotonic() - fault_end < limit:
+            voltage = read_input_registers(1, session)[0]
+            if voltage is not None and time.monotonic() >= fault_end:
+                return {'fault_seconds': fault_seconds, 'failed_polls': failed_polls,
+                        'recovery_seconds': round(time.monotonic() - fault_end, 3)}
+            if voltage is None:
+                failed_polls += 1
+        return {'fault_seconds': fault_seconds, 'failed_polls': failed_polls, 'recovery_seconds': None}
+    finally:
+        session.close()
+        simulator.close()
+
+
+def run(args):
+    return {
+        'benchmark': 'modbus poll cycle',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {'units': args.units, 'rounds': args.rounds, 'latency': args.latency,
+                     'timeout': args.timeout, 'fault': args.fault},
+        'poll': bench_poll(args.units, args.rounds, args.latency, args.timeout),
+        'poll_garbled': bench_poll(args.units, args.rounds, args.latency, args.timeout, garble_rate=0.05),
+        'discovery': bench_discovery(args.timeout, args.latency),
+        'recovery': bench_recovery(args.fault, args.timeout, args.latency),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Modbus driver against a simulated BMS.")
+    parser.add_argument('--units', type=int, nargs='+', default=UNIT_IDS, help="simulated unit IDs")
+    parser.add_argument('--rounds', type=int, default=200, help="poll cycles to time")
+    parser.add_argument('--latency', type=float, default=0.005, help="simulated device latency, seconds")
+    parser.add_argument('--timeout', type=float, default=0.2, help="Modbus response timeout, seconds")
+    parser.add_argument('--fault', type=float, default=2.0, help="length of the injected outage, seconds")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # The driver logs to stderr, so stdout carries only the JSON
+    text = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
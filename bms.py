@@ -0,0 +1,107 @@
+import time
+
+# Start of the process, as near as Python code can see it, for the start-up time
+STARTED = time.monotonic()
+
+import argparse
+import sys
+import logs
+
+# Each subcommand imports what it needs when it runs: tkinter only for the
+# GUI, pymodbus only when a serial port is opened, sockets only for the
+# commands that use the network.
+
+
+def acquire(args):
+    from acquisition import monitor_modbus, PORTS, METRICS_PORT
+    metrics_port = METRICS_PORT if args.metrics_port is None else args.metrics_port
+    monitor_modbus(args.ports or PORTS, metrics_port, started=STARTED)
+
+
+def gui(args):
+    import GUI
+    from sample_log import parse_time
+    replay = None
+    if args.replay:
+        try:
+            replay = [parse_time(text) for text in args.replay]
+        except argparse.ArgumentTypeError as e:
+            return "bms gui: {}".format(e)
+    GUI.main(args.ports or GUI.PORTS, GUI.METRICS_PORT if args.metrics_port is None else args.metrics_port,
+             replay, args.speed)
+
+
+def serve(args):
+    import Socket_server
+    metrics_port = Socket_server.METRICS_PORT if args.metrics_port is None else args.metrics_port
+    Socket_server.start_tcp_server(port=args.port or Socket_server.PORT, metrics_port=metrics_port)
+
+
+def relay(args):
+    from relay import Relay, RELAYS, RELAY_ROOT
+    if args.number not in RELAYS:
+        return "bms relay: no relay {}, choose from {}".format(args.number, sorted(RELAYS))
+    switch = Relay(args.number, args.root or RELAY_ROOT)
+    switch.set(args.state)
+    switch.close()
+    return 1 if switch.error else 0
+
+
+def replay(args):
+    import sample_log
+    return sample_log.main(args.extra)
+
+
+def bench(args):
+    import benchmark
+    return benchmark.main(args.extra)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bms', description="Battery monitor: acquisition, display, server and tools.")
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('acquire', help="poll the batteries headless and send their samples")
+    command.add_argument('ports', nargs='*', help="serial ports or globs (default /dev/ttyUSB*)")
+    command.add_argument('--metrics-port', type=int, help="Prometheus endpoint port, 0 for none")
+    command.set_defaults(run=acquire)
+
+    command = commands.add_parser('gui', help="poll the batteries and show them on the touch screen")
+    command.add_argument('ports', nargs='*', help="serial ports or globs (default /dev/ttyUSB*)")
+    command.add_argument('--metrics-port', type=int, help="Prometheus endpoint port, 0 for none")
+    command.add_argument('--replay', nargs=2, metavar=('START', 'END'),
+                         help="show recorded samples from START to END instead of polling")
+    command.add_argument('--speed', type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+    command.set_defaults(run=gui)
+
+    command = commands.add_parser('serve', help="receive telemetry over TCP and relay it over UDP")
+    command.add_argument('--port', type=int, help="TCP port to listen on (default 12345)")
+    command.add_argument('--metrics-port', type=int, help="Prometheus endpoint port, 0 for none")
+    command.set_defaults(run=serve)
+
+    command = commands.add_parser('relay', help="switch a relay on or off")
+    command.add_argument('number', type=int, help="relay number, e.g. 2")
+    command.add_argument('state', choices=['on', 'off'])
+    command.add_argument('--root', help="sysfs directory of the relays (default /sys/class/leds)")
+    command.set_defaults(run=relay)
+
+    # Options after replay go to sample_log.py, see bms replay --help
+    command = commands.add_parser('replay', help="print or send recorded samples", add_help=False)
+    command.set_defaults(run=replay)
+
+    # Options after bench go to benchmark.py, see bms bench --help
+    command = commands.add_parser('bench', help="benchmark the driver against a simulated BMS", add_help=False)
+    command.set_defaults(run=bench)
+
+    args, extra = parser.parse_known_args(argv)
+    args.extra = extra
+    if args.extra and args.run not in (replay, bench):
+        parser.error("unrecognized arguments: {}".format(' '.join(args.extra)))
+    logs.configure(level=getattr(logs, args.log_level.upper()))
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import argparse
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+from modID_1 import poll_registers
+from register_map import TYPES, WORD_ORDERS
+
+READ_INPUT_REGISTERS = 4
+ILLEGAL_FUNCTION = 1
+
+
+def lrc(data):
+    """
+    Modbus ASCII longitudinal redundancy check of the frame bytes.
+    """
+    return -sum(data) & 0xFF
+
+
+def default_values(unit):
+    """
+    Telemetry a simulated battery starts with; each unit reads a little differently.
+    """
+    return {'voltage': 52.0 + unit / 100, 'temp': 25, 'current': -1.0, 'capacity': 55.5 + unit}
+
+
+class BmsSimulator(object):
+    """
+    Simulated BMS string on a pseudo-terminal, answering Modbus ASCII
+    "read input registers" requests for the configured unit IDs from the
+    values in self.values, encoded with modID_1's register map.
+
+    Faults can be injected at any time: latency (+ random jitter) before
+    each answer, timeout_rate (fraction of requests left unanswered),
+    garble_rate (fraction of answers with a corrupted character) and
+    silence(seconds) to stop answering altogether for a while.
+
+    Point the driver at self.port. Pseudo-terminals do not reliably take
+    7-bit framing, so open it with parity='N', bytesize=8.
+    """
+
+    def __init__(self, unit_ids=(1,), latency=0.0, jitter=0.0, timeout_rate=0.0, garble_rate=0.0,
+                 registers=poll_registers, seed=None):
+        self.unit_ids = set(unit_ids)
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.garble_rate = garble_rate
+        self.registers = registers
+        self.random = random.Random(seed)
+        self.values = dict((unit, default_values(unit)) for unit in self.unit_ids)
+        self.silent_until = 0.0
+        self.requests = 0
+        self.answered = 0
+        self.garbled = 0
+        self.running = True
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self.run, name="bms simulator", daemon=True)
+        self.thread.start()
+
+    def silence(self, seconds):
+        """
+        Answer nothing for the next seconds, like a cable pulled and replugged.
+        """
+        self.silent_until = time.monotonic() + seconds
+
+    def register_values(self, unit):
+        """
+        Encode a unit's values into a dict of address -> register.
+        """
+        registers = {}
+        for name, address, type_name, word_order, divisor in self.registers:
+            value = self.values[unit].get(name, 0) * divisor
+            code, count = TYPES[type_name]
+            if code != 'f':
+                value = int(round(value))
+            raw = struct.pack(WORD_ORDERS[word_order] + code, value)
+            for i, register in enumerate(struct.unpack(WORD_ORDERS[word_order] + 'H' * count, raw)):
+                registers[address + i] = register
+        return registers
+
+    def answer(self, request):
+        """
+        Build the response frame body for a decoded request, or None to stay silent.
+        """
+        unit, function = request[0], request[1]
+        if unit not in self.unit_ids:
+            return None  # Another unit's request; on RS-485 nobody answers
+        if function != READ_INPUT_REGISTERS:
+            return bytes([unit, function | 0x80, ILLEGAL_FUNCTION])
+        address, count = struct.unpack('>HH', request[2:6])
+        registers = self.register_values(unit)
+        data = b''.join(struct.pack('>H', registers.get(address + i, 0)) for i in range(count))
+        return bytes([unit, function, len(data)]) + data
+
+    def handle(self, line):
+        start = line.find(b':')
+        if start < 0:
+            return
+        try:
+            frame = bytes.fromhex(line[start + 1:].decode('ascii'))
+        except ValueError:
+            return
+        if len(frame) < 7 or lrc(frame[:-1]) != frame[-1]:
+            return
+        self.requests += 1
+        if time.monotonic() < self.silent_until or self.random.random() < self.timeout_rate:
+            return
+        body = self.answer(frame[:-1])
+        if body is None:
+            return
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        response = b':' + (body + bytes([lrc(body)])).hex().upper().encode() + b'\r\n'
+        if self.random.random() < self.garble_rate:
+            i = self.random.randrange(1, len(response) - 2)
+            response = response[:i] + (b'0' if response[i:i + 1] != b'0' else b'1') + response[i + 1:]
+            self.garbled += 1
+        else:
+            self.answered += 1
+        os.write(self.master, response)
+
+    def run(self):
+        buffer = b''
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.2)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                break
+            while b'\r\n' in buffer:
+                line, buffer = buffer.split(b'\r\n', 1)
+                self.handle(line)
+
+    def close(self):
+        self.running = False
+        self.thread.join(1)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate BMS units on a pseudo-terminal.")
+    parser.add_argument('units', type=int, nargs='*', default=[1], help="unit IDs to answer on")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before each answer")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="fraction of requests not answered")
+    parser.add_argument('--garble-rate', type=float, default=0.0, help="fraction of answers corrupted")
+    args = parser.parse_args(argv)
+
+    simulator = BmsSimulator(args.units, args.latency, args.jitter, args.timeout_rate, args.garble_rate)
+    print("Simulating units {} on {} (use parity N, 8 data bits).".format(sorted(simulator.unit_ids), simulator.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
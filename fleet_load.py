@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import random
+import socket
+import sys
+import threading
+import time
+from sender import RECEIVER_IP, RECEIVER_PORT, format_message
+from wire_format import encode_frame
+
+# Where UDP mode sends by default: the OpenRVDAS broadcast port
+UDP_TARGET = ('<broadcast>', 65534)
+
+
+class Battery(object):
+    """
+    A simulated battery module cycling between charging and discharging.
+
+    Capacity follows the current (coulomb counting), voltage follows
+    capacity with an IR drop, and temperature relaxes towards a level set
+    by the current, so the trajectories look like a real pack's.
+    """
+
+    def __init__(self, modID, rng, capacity_ah=100.0):
+        self.modID = modID
+        self.rng = rng
+        self.capacity_ah = capacity_ah
+        self.capacity = rng.uniform(25, 90)
+        self.charging = rng.random() < 0.5
+        self.amps = rng.uniform(10, 40)
+        self.temp = rng.uniform(20, 28)
+        self.current = 0.0
+        self.voltage = 0.0
+        self.last = time.monotonic()
+
+    def step(self):
+        now = time.monotonic()
+        dt = now - self.last
+        self.last = now
+        if self.capacity >= 92:
+            self.charging = False
+        elif self.capacity <= 24:
+            self.charging = True
+        self.current = (self.amps if self.charging else -self.amps) + self.rng.gauss(0, 0.3)
+        self.capacity = min(100.0, max(0.0, self.capacity + 100 * self.current * dt / (3600 * self.capacity_ah)))
+        self.voltage = 48.0 + 0.08 * self.capacity + 0.01 * self.current + self.rng.gauss(0, 0.02)
+        target = 25 + 0.3 * abs(self.current)
+        self.temp += (target - self.temp) * min(1.0, dt / 600) + self.rng.gauss(0, 0.05)
+        return self.voltage, self.temp, self.current, self.capacity
+
+
+class Link(object):
+    """
+    One battery's connection to the receiver: a TCP stream or a UDP socket.
+    """
+
+    def __init__(self, protocol, target):
+        self.protocol = protocol
+        self.target = target
+        self.sock = None
+        self.retry_at = 0.0
+
+    def open(self):
+        if self.protocol == 'tcp':
+            self.sock = socket.create_connection(self.target, timeout=5)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def send(self, data):
+        if self.protocol == 'tcp':
+            self.sock.sendall(data)
+        else:
+            self.sock.sendto(data, self.target)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def encode(battery, wire_format, sequence):
+    voltage, temp, current, capacity = battery.step()
+    if wire_format == 'binary':
+        return encode_frame(battery.modID, sequence, time.time(), voltage, temp, current, capacity)
+    # The send_data line, plus the send time so the relayed copy gives the latency
+    line = format_message(voltage, temp, current, capacity, battery.modID)
+    return "{}, sent={:.6f}\n".format(line.rstrip('\n'), time.time()).encode()
+
+
+def worker(index, modIDs, options, start_at, results):
+    """
+    Simulate the batteries modIDs at options['rate'] samples per second
+    in total, until options['duration'] seconds after start_at.
+    """
+    rng = random.Random(index)
+    batteries = [Battery(modID, rng) for modID in modIDs]
+    sequences = [itertools.count() for _ in batteries]
+    links = [Link(options['protocol'], options['target']) for _ in batteries]
+    stats = {'sent': 0, 'bytes': 0, 'errors': 0, 'reconnects': 0}
+    interval = 1.0 / options['rate'] if options['rate'] else 0.0
+    churn = options['churn']
+    burst_every = options['burst_every']
+
+    time.sleep(max(0.0, start_at - time.time()))
+    start = time.monotonic()
+    end = start + options['duration']
+    next_send = start
+    next_burst = start + burst_every if burst_every else None
+    next_churn = start + 1.0
+    for i in itertools.cycle(range(len(batteries))):
+        now = time.monotonic()
+        if now >= end:
+            break
+        if interval and next_send > now:
+            time.sleep(next_send - now)
+        next_send += interval
+
+        count = 1
+        if next_burst is not None and now >= next_burst:
+            count = options['burst_size']  # e.g. a spool replayed after an outage
+            next_burst += burst_every
+        if churn and now >= next_churn:
+            # Once a second, each connection is dropped with probability churn
+            next_churn += 1.0
+            for link in links:
+                if link.sock is not None and rng.random() < churn:
+                    link.close()
+                    stats['reconnects'] += 1
+
+        link = links[i]
+        try:
+            if link.sock is None:
+                if now < link.retry_at:
+                    continue
+                link.open()
+            data = b''.join(encode(batteries[i], options['format'], next(sequences[i])) for _ in range(count))
+            link.send(data)
+            stats['sent'] += count
+            stats['bytes'] += len(data)
+        except OSError:
+            stats['errors'] += 1
+            link.close()
+            link.retry_at = now + 1.0
+    stats['elapsed'] = time.monotonic() - start
+    for link in links:
+        link.close()
+    results.put(stats)
+
+
+class RelayListener(object):
+    """
+    Counts the records the socket server relays back over UDP (point one
+    of its UDP_TARGETS here) and their latency from the send time they carry.
+    """
+
+    def __init__(self, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.settimeout(0.5)
+        self.records = 0
+        self.latencies = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="relay listener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                datagram = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            received = time.time()
+            for line in datagram.split(b'\n'):
+                if not line.strip():
+                    continue
+                self.records += 1
+                for field in line.split(b','):
+                    name, _, value = field.strip().partition(b'=')
+                    if name in (b'sent', b'timestamp'):
+                        try:
+                            self.latencies.append(received - float(value))
+                        except ValueError:
+                            pass
+                        break
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1)
+        self.sock.close()
+
+
+def latency_summary(values):
+    """
+    Percentiles of latencies in milliseconds, None without samples.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = dict(('p{}'.format(point), round(1000 * ordered[max(0, math.ceil(len(ordered) * point / 100) - 1)], 3))
+                  for point in (50, 90, 99))
+    result['max'] = round(1000 * ordered[-1], 3)
+    return result
+
+
+def parse_target(text):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a fleet of batteries sending telemetry.")
+    parser.add_argument('--batteries', type=int, default=100, help="number of simulated batteries")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help="sender processes")
+    parser.add_argument('--rate', type=float, default=100.0, help="samples per second, all batteries together")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds to run")
+    parser.add_argument('--protocol', choices=['tcp', 'udp'], default='tcp')
+    parser.add_argument('--format', choices=['text', 'binary'], default='text', help="TCP wire format")
+    parser.add_argument('--target', type=parse_target,
+                        help="host:port to send to (default the receiver for TCP, broadcast 65534 for UDP)")
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help="chance per second that each connection is dropped and reopened")
+    parser.add_argument('--burst-every', type=float, default=0.0, help="seconds between bursts, 0 for none")
+    parser.add_argument('--burst-size', type=int, default=100, help="samples sent back to back in a burst")
+    parser.add_argument('--listen', type=int, default=0,
+                        help="UDP port to count the server's relayed records on, 0 for none")
+    args = parser.parse_args(argv)
+
+    if args.target is None:
+        args.target = (RECEIVER_IP, RECEIVER_PORT) if args.protocol == 'tcp' else UDP_TARGET
+    if args.protocol == 'udp':
+        args.format = 'text'  # OpenRVDAS reads the text lines
+    processes = max(1, min(args.processes, args.batteries))
+    # Binary frames carry the unit ID in one byte
+    modIDs = [1 + i % 255 for i in range(args.batteries)]
+    options = {'rate': args.rate / processes, 'duration': args.duration, 'protocol': args.protocol,
+               'format': args.format, 'target': args.target, 'churn': args.churn,
+               'burst_every': args.burst_every, 'burst_size': args.burst_size}
+
+    listener = RelayListener(args.listen) if args.listen else None
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0  # Let every process get ready first
+    workers = [multiprocessing.Process(target=worker, args=(i, modIDs[i::processes], options, start_at, results))
+               for i in range(processes)]
+    for process in workers:
+        process.start()
+    stats = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+    if listener:
+        time.sleep(1.0)  # Records still on their way through the server
+        listener.stop()
+
+    elapsed = max(stat['elapsed'] for stat in stats)
+    sent = sum(stat['sent'] for stat in stats)
+    report = {
+        'batteries': args.batteries,
+        'processes': processes,
+        'protocol': args.protocol,
+        'format': args.format,
+        'target_rate': args.rate,
+        'sent': sent,
+        'send_rate': round(sent / elapsed, 1),
+        'bytes_per_second': round(sum(stat['bytes'] for stat in stats) / elapsed, 1),
+        'errors': sum(stat['errors'] for stat in stats),
+        'reconnects': sum(stat['reconnects'] for stat in stats),
+    }
+    if listener:
+        report['acknowledged'] = listener.records
+        report['acknowledged_rate'] = round(listener.records / elapsed, 1)
+        report['latency_ms'] = latency_summary(listener.latencies)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import atexit
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+# Records below this level are discarded by the caller
+LEVEL = INFO
+
+# Rate limit: at most RATE_BURST records of one message per RATE_WINDOW
+# seconds, then a single summary with the number suppressed
+RATE_BURST = 5
+RATE_WINDOW = 60.0
+
+# Records waiting for the writer; beyond this they are dropped and counted
+QUEUE_SIZE = 10000
+
+
+def format_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="\\\n'):
+        text = '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    return text
+
+
+def format_record(timestamp, level, name, message, fields):
+    """
+    One logfmt line: time=... level=... logger=... msg=... key=value...
+    """
+    parts = ['time={}.{:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)),
+                                       int(timestamp * 1000) % 1000),
+             'level=' + LEVEL_NAMES.get(level, str(level)),
+             'logger=' + format_value(name),
+             'msg=' + format_value(message)]
+    parts.extend('{}={}'.format(key, format_value(value)) for key, value in fields.items())
+    return ' '.join(parts) + '\n'
+
+
+class LogWriter(object):
+    """
+    Writes log records from a background thread.
+
+    submit() only puts the record on a bounded queue and never blocks, so
+    a slow console or a full journald pipe cannot stall the poller; when
+    the queue is full the record is dropped and counted. Formatting,
+    rate limiting and I/O all happen on the writer thread. Each message
+    (per logger) may be written burst times per window seconds; further
+    copies are counted and reported in one summary record when the window
+    ends.
+    """
+
+    def __init__(self, stream=None, level=LEVEL, burst=RATE_BURST, window=RATE_WINDOW, maxsize=QUEUE_SIZE):
+        self.stream = stream  # None writes to the current sys.stderr
+        self.level = level
+        self.burst = burst
+        self.window = window
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.windows = {}  # (logger, message) -> [window start, written, suppressed, level]
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="log writer", daemon=True)
+                self.thread.start()
+        return self
+
+    def submit(self, level, name, message, fields):
+        if level < self.level:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, name, message, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self, timestamp, level, name, message, fields):
+        """
+        Text for one record: '' if it is suppressed, preceded by the summary
+        of the message's previous window if that window has just ended.
+        """
+        key = (name, message)
+        window = self.windows.get(key)
+        summary = ''
+        if window is None or timestamp - window[0] >= self.window:
+            summary = self.summarise(key, window, timestamp)
+            window = self.windows[key] = [timestamp, 0, 0, level]
+        if window[1] >= self.burst:
+            window[2] += 1
+            return summary
+        window[1] += 1
+        return summary + format_record(timestamp, level, name, message, fields)
+
+    def summarise(self, key, window, now):
+        """
+        Text of the summary for a window finished at now, '' if nothing was suppressed.
+        """
+        if window is None or not window[2]:
+            return ''
+        return format_record(now, window[3], key[0], key[1],
+                             {'suppressed': window[2], 'seconds': round(now - window[0])})
+
+    def expire(self):
+        now = time.time()
+        text = ''
+        for key, window in list(self.windows.items()):
+            if now - window[0] >= self.window:
+                text += self.summarise(key, window, now)
+                del self.windows[key]
+        if self.dropped != self.reported_dropped:
+            text += format_record(now, WARNING, 'logs', "Log queue full, records dropped",
+                                  {'dropped': self.dropped - self.reported_dropped})
+            self.reported_dropped = self.dropped
+        return text
+
+    def output(self, text):
+        if text:
+            try:
+                stream = self.stream or sys.stderr
+                stream.write(text)
+                stream.flush()
+            except (OSError, ValueError):
+                pass  # Nowhere left to log to
+
+    def run(self):
+        last_expire = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                record = None
+            text = ''
+            while record is not None:
+                text += self.write(*record)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            if time.monotonic() - last_expire >= 1.0:
+                text += self.expire()
+                last_expire = time.monotonic()
+            self.output(text)  # One write per batch of records
+
+    def flush(self, timeout=2.0):
+        """
+        Wait up to timeout seconds for the queued records to be written.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class Logger(object):
+    """
+    Named source of structured records: a constant message plus key/value
+    fields, e.g. log.info("Found unit", modID=2, port='/dev/ttyUSB0').
+    Keep the message constant and put the variable parts in fields, so
+    repeats are recognised and rate-limited.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def debug(self, message, /, **fields):
+        shared_writer().submit(DEBUG, self.name, message, fields)
+
+    def info(self, message, /, **fields):
+        shared_writer().submit(INFO, self.name, message, fields)
+
+    def warning(self, message, /, **fields):
+        shared_writer().submit(WARNING, self.name, message, fields)
+
+    def error(self, message, /, **fields):
+        shared_writer().submit(ERROR, self.name, message, fields)
+
+
+# Process-wide writer, created by shared_writer()
+writer = None
+writer_lock = threading.Lock()
+
+
+def shared_writer():
+    """
+    Return the process-wide LogWriter, starting it on the first call.
+    Queued records are written at exit.
+    """
+    global writer
+    if writer is None:
+        with writer_lock:
+            if writer is None:
+                writer = LogWriter().start()
+                atexit.register(writer.flush)
+    return writer
+
+
+def configure(level=None, stream=None, burst=None, window=None):
+    """
+    Change the level, output stream or rate limit of the process-wide writer.
+    """
+    shared = shared_writer()
+    if level is not None:
+        shared.level = level
+    if stream is not None:
+        shared.stream = stream
+    if burst is not None:
+        shared.burst = burst
+    if window is not None:
+        shared.window = window
+
+
+def get_logger(name):
+    return Logger(name)
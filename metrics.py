@@ -0,0 +1,218 @@
+import bisect
+import threading
+from logs import get_logger
+
+log = get_logger('metrics')
+
+# Default histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """
+    A value that only goes up. set_function() makes it read a callable at
+    scrape time instead, e.g. a counter attribute an object keeps anyway.
+    """
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, such as a queue depth.
+    """
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """
+    Counts of observations in fixed buckets (upper bounds), plus their sum.
+    observe() is a bisect and three additions.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Family(object):
+    """
+    One named metric and its children, one per combination of label values.
+    An unlabelled metric has a single child, which inc(), set(), observe()
+    and set_function() act on directly.
+    """
+
+    def __init__(self, kind, name, help, labelnames, make):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.make = make
+        self.children = {}  # tuple of label values -> child
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()  # Shown as 0 before the first update
+
+    def labels(self, *values):
+        """
+        The child for these label values; keep it to skip the lookup on a hot path.
+        """
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError("{} takes labels {}".format(self.name, self.labelnames))
+            with self.lock:
+                child = self.children.setdefault(key, self.make())
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.help))
+        lines.append("# TYPE {} {}".format(self.name, self.kind))
+        for key, child in sorted(self.children.items()):
+            labels = ['{}="{}"'.format(name, escape(value)) for name, value in zip(self.labelnames, key)]
+            if self.kind != 'histogram':
+                lines.append("{}{} {}".format(self.name, braces(labels), float(child.get())))
+                continue
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(child.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, braces(labels + ['le="{}"'.format(le)]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, braces(labels), total))
+            lines.append("{}_count{} {}".format(self.name, braces(labels), cumulative))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def braces(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Registry(object):
+    """
+    All metric families of a process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def family(self, kind, name, help, labelnames, make):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(kind, name, help, labelnames, make)
+            elif family.kind != kind:
+                raise ValueError("{} is already registered as a {}".format(name, family.kind))
+            return family
+
+    def render(self):
+        lines = []
+        for name in sorted(self.families):
+            self.families[name].render(lines)
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry the functions below register in
+registry = Registry()
+
+
+def counter(name, help, labelnames=()):
+    """
+    Return the counter family name, registering it on first use.
+    """
+    return registry.family('counter', name, help, labelnames, Counter)
+
+
+def gauge(name, help, labelnames=()):
+    """
+    Return the gauge family name, registering it on first use.
+    """
+    return registry.family('gauge', name, help, labelnames, Gauge)
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    """
+    Return the histogram family name, registering it on first use.
+    """
+    return registry.family('histogram', name, help, labelnames, lambda: Histogram(buckets))
+
+
+def start_http_server(port, host='127.0.0.1', registry=registry):
+    """
+    Serve the registry at http://host:port/metrics from a background thread.
+    Returns the server, or None if the port cannot be bound.
+    """
+    # Imported here: http.server pulls in the email package, which would
+    # double the import time of every module that records a metric
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # No console line per scrape
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log.warning("Metrics endpoint unavailable", host=host, port=port, error=e)
+        return None
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics http", daemon=True).start()
+    return server
@@ -1,11 +1,16 @@
 import threading
 import time
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-import struct
-import socket  # Add socket import
-
-# Initialize Modbus client configuration
-client = ModbusClient(method='ascii', port='/dev/ttyUSB0', baudrate=115200, parity='E', stopbits=1, bytesize=7)
+import random
+from collections import namedtuple
+import metrics
+from logs import get_logger
+from register_map import RegisterMap
+from safety import SAFETY_RULES
+from sender import encode_sample, shared_sender
+
+# Modbus serial configuration
+PORT = '/dev/ttyUSB0'
+BAUDRATE = 115200
 
 # Define register addresses (0-based for pymodbus)
 address_voltage = 30001 - 30001
@@ -13,170 +18,464 @@ address_temp = 31001 - 30001
 address_current = 33003 - 30001
 address_capacity = 34001 - 30001
 
-# Shared variables
-modID_in_use = None
-last_data_time = None
-lock = threading.Lock()
+# Registers read on every poll: name, address, type, word order, divisor.
+# Further BMS values (cell voltages, cycle count, alarm bits) are added as more entries.
+poll_registers = [
+    ('voltage', address_voltage, 'uint16', 'big', 1000),  # mV
+    ('temp', address_temp, 'int16', 'big', 1),  # °C
+    ('current', address_current, 'int32', 'big', 1000),  # mA, high word first
+    ('capacity', address_capacity, 'float32', 'big', 1),  # %
+]
+
+# Unit IDs a battery BMS may answer on
+UNIT_IDS = [1, 2, 3, 4]
+
+# Adaptive polling: how close to a safety rule's threshold counts as near, and
+# rates of change (units per second) that count as fast
+NEAR_MARGINS = {'temp': 3.0, 'capacity': 3.0}  # A field not listed counts only past the threshold
+FAST_RATES = {'current': 0.5, 'temp': 0.05}
+IDLE_CURRENT = 0.5  # Amps below which the pack counts as idle
+
+# One decoded poll of one battery
+Sample = namedtuple('Sample', ['voltage', 'temp', 'current', 'capacity', 'modID', 'timestamp', 'port'],
+                    defaults=(None,))
+
+log = get_logger('modID_1')
+
+transaction_seconds = metrics.histogram('bms_modbus_transaction_seconds',
+                                        "Time of one Modbus read of a register block.", ['port', 'block'])
+read_errors = metrics.counter('bms_modbus_read_errors_total', "Register block reads that failed.", ['port', 'unit'])
+discovery_attempts = metrics.counter('bms_discovery_attempts_total', "Unit IDs probed for a battery.", ['port', 'unit'])
+link_downs = metrics.counter('bms_modbus_link_down_total', "Times a serial link was closed after failing.", ['port'])
+
+
+class ModbusSession(object):
+    """
+    Long-lived Modbus connection that holds the serial port open across polls.
+
+    A link failure (the port erroring or disappearing, or max_failures
+    timeouts / bad frames in a row while no other unit answers) closes the
+    port; one battery going quiet does not cut off the rest of the bus. The next request
+    reopens it after a jittered exponential backoff, which only resets once
+    a transaction succeeds: a port that opens but never answers backs off
+    as far as one that cannot be opened.
+    """
+
+    def __init__(self, port=PORT, baudrate=BAUDRATE, parity='E', stopbits=1, bytesize=7,
+                 timeout=1, max_failures=3, backoff_base=0.5, backoff_max=30.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+        self.bytesize = bytesize
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.client = None
+        self.failures = 0  # Consecutive timeouts / bad frames
+        self.answering = set()  # Unit IDs whose last transaction succeeded
+        self.reconnects = 0  # Link failures since the last successful transaction
+        self.next_attempt = 0.0
+        self.lock = threading.RLock()
+
+    def connect(self):
+        """
+        Open the serial port if it is not open, waiting out any backoff first.
+        Returns True when the port is open.
+        """
+        with self.lock:
+            if self.client is not None and self.client.is_socket_open():
+                return True
+
+            delay = self.next_attempt - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            # Imported on first use: pymodbus is most of this module's import time
+            from pymodbus.client.sync import ModbusSerialClient as ModbusClient
+
+            # Build a fresh client so a re-enumerated USB adapter is picked up
+            self.client = ModbusClient(method='ascii', port=self.port, baudrate=self.baudrate,
+                                       parity=self.parity, stopbits=self.stopbits,
+                                       bytesize=self.bytesize, timeout=self.timeout,
+                                       reset_socket=False)  # Keep the port open after a timeout
+            try:
+                opened = self.client.connect()
+            except Exception as e:  # e.g. termios errors from a half-removed adapter
+                self.client = None
+                self.link_down("cannot open {}: {}".format(self.port, e))
+                return False
+            if opened:
+                self.failures = 0
+                return True
+
+            self.link_down("cannot open {}".format(self.port))
+            return False
+
+    def link_down(self, reason):
+        """
+        Close the port and schedule the next connection attempt.
+        """
+        with self.lock:
+            link_downs.labels(self.port).inc()
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+            delay = min(self.backoff_max, self.backoff_base * 2 ** self.reconnects)
+            delay = random.uniform(delay / 2, delay)  # Jitter so several buses do not retry in lockstep
+            self.reconnects += 1
+            self.failures = 0
+            self.answering.clear()
+            self.next_attempt = time.time() + delay
+            log.warning("Modbus link down", port=self.port, reason=reason, retry_in=round(delay, 1))
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+    def read_input_registers(self, address, count=1, unit=1, probe=False):
+        """
+        Read input registers over the held connection.
+
+        :param probe: True when no answer is a normal outcome (unit discovery),
+                      so a timeout does not count as a link failure.
+        :return: the pymodbus response, or None if the link is down.
+        """
+        from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+        with self.lock:
+            if not self.connect():
+                return None
+            try:
+                result = self.client.read_input_registers(address, count=count, unit=unit)
+            except (ConnectionException, OSError) as e:  # serial.SerialException is an OSError
+                self.link_down(str(e))
+                return None
+
+            if isinstance(result, ModbusIOException):  # Timeout or frame that failed to decode
+                if not probe:
+                    self.answering.discard(unit)
+                    if not self.answering:
+                        self.failures += 1
+                    if self.failures >= self.max_failures:
+                        self.link_down("{} failed transactions in a row".format(self.failures))
+            else:
+                self.answering.add(unit)
+                if self.reconnects:
+                    log.info("Reconnected", port=self.port)
+                self.reconnects = 0
+                self.failures = 0
+            return result
+
+
+# Default session for this process
+bus_session = ModbusSession()
 
 
 def check_modID():
     """
     Check Modbus IDs (1, 2, 3, 4) to find which one has valid data.
     If data is found, return the modID.
-    Attempt to reconnect to the USB device if the connection fails.
-    """
-    global client
-
-    print("Checking Modbus IDs...")
-    for modID in [1, 2, 3, 4]:
-        print("Attempting to read voltage for modID {modID}...")
-
-        # Check and reconnect if client is not connected
-        if not client.connect():
-            print("Client connection failed. Reinitializing...")
-            client = ModbusClient(method='ascii', port='/dev/ttyUSB0', baudrate=115200, parity='E', stopbits=1, bytesize=7)
-            time.sleep(2)  # Small delay to allow reconnection
-
-        # Attempt to read voltage data
-        try:
-            result_voltage = client.read_input_registers(address_voltage, count=1, unit=modID)
-            if not result_voltage.isError() and result_voltage.registers:  # Ensure valid data
-                print("Data found for modID {modID}.")
-                return modID
-            else:
-                print("No data for modID {modID}.")
-        except Exception as e:
-            print("Error while reading modID {modID}: {e}")
+    The session reconnects to the USB device if the connection fails.
+    """
+    log.info("Checking Modbus IDs")
+    for modID in UNIT_IDS:
+        log.debug("Attempting to read voltage", modID=modID)
+        found = probe_unit(modID)
+        if found is None:
+            return None  # Link is down, the session is backing off
+        if found:
+            log.info("Data found", modID=modID)
+            return modID
+        log.debug("No data", modID=modID)
 
     return None  # If no data is found for any modID
 
 
-def read_input_registers(modID):
+def probe_unit(modID, session=None):
     """
-    Reads input registers from the battery with the provided modID and returns
-    the voltage, temperature, current, relative capacity values, and modID.
+    Read the voltage register of one unit ID to see whether a battery answers on it.
+    Returns True or False, or None if the link is down.
     """
-    global last_data_time
+    session = session or bus_session
+    discovery_attempts.labels(session.port, modID).inc()
     try:
-        if not client.connect():
-            print("Failed to connect to Modbus client.")
-            return None, None, None, None, modID
-
-        # Voltage
-        result_voltage = client.read_input_registers(address_voltage, count=1, unit=modID)
-        voltage_value = round(result_voltage.registers[0] / 1000, 2) if not result_voltage.isError() else None
-
-        # Temperature
-        result_temp = client.read_input_registers(address_temp, count=1, unit=modID)
-        temp_value = result_temp.registers[0]
-        if temp_value > 32767:
-            temp_value -= 65536
-        temp_value = round(temp_value, 2)
-
-        # Current
-        result_current = client.read_input_registers(address_current, count=2, unit=modID)
-        if not result_current.isError():
-            high, low = result_current.registers
-            raw_current_value = (high << 16) | low
-            if raw_current_value > 2147483647:
-                raw_current_value -= 4294967296
-            current_value = round(raw_current_value / 1000.0, 2)
-        else:
-            current_value = None
-
-        # Relative Capacity
-        result_capacity = client.read_input_registers(address_capacity, count=2, unit=modID)
-        if not result_capacity.isError():
-            high, low = result_capacity.registers
-            combined = (high << 16) | low
-            capacity_value = round(struct.unpack('!f', struct.pack('!I', combined))[0], 2)
-        else:
-            capacity_value = None
+        result_voltage = session.read_input_registers(address_voltage, count=1, unit=modID, probe=True)
+        if result_voltage is None:
+            return None
+        return not result_voltage.isError() and bool(result_voltage.registers)  # Ensure valid data
+    except Exception as e:
+        log.warning("Error while probing", modID=modID, error=e)
+        return False
 
-        # Update last data time if data is valid
-        if voltage_value is not None or current_value is not None:
-            with lock:
-                last_data_time = time.time()
 
-        return voltage_value, temp_value, current_value, capacity_value, modID
-
-    finally:
-        client.close()
+def discover_units(unit_ids=UNIT_IDS, session=None):
+    """
+    Return every unit ID in unit_ids that answers, rather than only the first.
+    """
+    found = []
+    for modID in unit_ids:
+        answered = probe_unit(modID, session)
+        if answered is None:
+            break  # Link is down, the session is backing off
+        if answered:
+            found.append(modID)
+    return found
 
 
-def send_data(voltage, temp, current, capacity, modID):
+def read_values(register_map, modID, session=None):
     """
-    Sends the real data via TCP to the specified receiver IP and port.
+    Read every block of a RegisterMap from one unit and decode it.
+    Returns a dict of name -> scaled value, None where a block failed.
+    After a timeout or with the link down the unit's remaining blocks are
+    skipped, so a unit that does not answer costs one timeout per poll.
     """
-   # sender_ip = '172.16.29.53' Kepp the binding open for DHCP
-    receiver_ip = '172.16.28.29'
-    port = 12345
+    from pymodbus.exceptions import ModbusIOException
 
-    # Define the message
-    message = "voltage={}, temp={}, current={}, capacity={}, modID={}\n".format(
-        round(voltage), round(temp), round(current), round(capacity), modID)
-    print("Debug: Message to be sent: {}".format(message))
+    session = session or bus_session
+    blocks = [None] * len(register_map.plan)
+    for i, (start, count, fields) in enumerate(register_map.plan):
+        begin = time.perf_counter()
+        result = session.read_input_registers(start, count=count, unit=modID)
+        if result is not None:
+            transaction_seconds.labels(session.port, start).observe(time.perf_counter() - begin)
+        if result is not None and not result.isError():
+            blocks[i] = result.registers
+            continue
+        read_errors.labels(session.port, modID).inc()
+        if result is None or isinstance(result, ModbusIOException):
+            break  # An exception response is the unit answering; anything else ends the poll
+    return register_map.decode(blocks)
 
-    # Create a TCP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-   # sock.bind((sender_ip, 0))
 
-    # Attempt to connect the socket to the specified IP address and port
-    while True:
-        try:
-            sock.connect((receiver_ip, port))
-            break
-        except ConnectionRefusedError:
-            print("Debug: Connection refused, retrying in 5 seconds...")
-            time.sleep(5)
+# Read plan and decoders for the registers read on every poll, compiled once
+poll_map = RegisterMap(poll_registers)
 
-    # Send the message to the specified port
-    sock.sendall(message.encode())
-    print("Debug: Message sent: {}".format(message))
 
-    # Close the socket
-    sock.close()
+def read_input_registers(modID, session=None):
+    """
+    Reads input registers from the battery with the provided modID and returns
+    the voltage, temperature, current, relative capacity values, and modID.
+    Uses the default session unless another bus's session is given.
+    """
+    session = session or bus_session
+    if not session.connect():
+        log.warning("Failed to connect to Modbus client", port=session.port)
+        return None, None, None, None, modID
+
+    values = read_values(poll_map, modID, session)
+    voltage_value, temp_value, current_value, capacity_value = [
+        None if values[name] is None else round(values[name], 2)
+        for name in ('voltage', 'temp', 'current', 'capacity')]
+    return voltage_value, temp_value, current_value, capacity_value, modID
 
 
-def monitor_modbus():
+def send_data(voltage, temp, current, capacity, modID, timestamp=None):
     """
-    Continuously monitor the selected modID for new data. If no new data is received
-    within 10 seconds, reset to checking all modIDs.
+    Queues the real data for the TCP receiver. Returns immediately; the shared
+    sender delivers it over its persistent connection.
     """
-    global modID_in_use, last_data_time
+    return shared_sender().send(encode_sample(voltage, temp, current, capacity, modID, timestamp))
 
-    while True:
-        if modID_in_use is not None:
-            print("Polling data for modID {modID_in_use}...")
-            data = read_input_registers(modID_in_use)
 
-            if data == (None, None, None, None, None):
-                print("No new data received. Displaying N/A.")
-            else:
-                voltage, temp, current, capacity, modID = data
-                print("Voltage: {voltage}V, Temp: {temp}°C, Current: {current}A, Capacity: {capacity}%")
-                send_data(voltage, temp, current, capacity, modID)  # Send data via TCP
-
-            # Check if 10 seconds have passed since the last data update
-            with lock:
-                if last_data_time and (time.time() - last_data_time > 15):
-                    print("No new data for 10 seconds. Resetting to check all modIDs...")
-                    modID_in_use = None  # Reset modID to restart the search
-                    last_data_time = None  # Clear last data time to avoid stale data
-
-        # If no modID is in use, search for a valid modID
-        if modID_in_use is None:
-            modID_in_use = check_modID()
-            if modID_in_use:
-                print("Found modID {modID_in_use}. Starting to poll data.")
-            else:
-                print("No valid modID found. Retrying in 5 seconds...")
-                time.sleep(5)  # Retry after a delay
+class AdaptivePoll(object):
+    """
+    Chooses each unit's next poll period from its latest sample.
+
+    A unit is polled every min_period seconds while one of the safety rules
+    is active for it (past its threshold and not yet cleared past its
+    hysteresis), while a value is within NEAR_MARGINS of a rule's threshold,
+    or while its current or temperature is changing faster than FAST_RATES.
+    An idle pack (current under IDLE_CURRENT, nothing changing fast) backs
+    off, doubling its period each poll up to max_period. Anything else is
+    polled at the scheduler's own period.
+    """
+
+    def __init__(self, min_period=1.0, max_period=10.0, rules=SAFETY_RULES, margins=NEAR_MARGINS,
+                 fast_rates=FAST_RATES, idle_current=IDLE_CURRENT):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.rules = list(rules)
+        self.margins = margins
+        self.fast_rates = fast_rates
+        self.idle_current = idle_current
+        self.previous = {}  # (port, modID) -> previous Sample
+        self.periods = {}  # (port, modID) -> period chosen last
+        self.active = {}  # (port, modID) -> names of the rules tripped and not cleared
+
+    def near_limit(self, key, sample):
+        """
+        True while a rule is active for the unit or a value is within the
+        margin of a threshold. Rules go active on the same operator as the
+        safety engine, without its debounce, so polling speeds up first.
+        """
+        active = self.active.setdefault(key, set())
+        near = False
+        for rule in self.rules:
+            value = getattr(sample, rule.field)
+            if value is None:
+                continue  # No reading; keep the rule as it was
+            if rule.tripped(value):
+                active.add(rule.name)
+            elif rule.cleared(value):
+                active.discard(rule.name)
+            if abs(value - rule.threshold) <= self.margins.get(rule.field, 0.0):
+                near = True
+        return near or bool(active)
+
+    def changing(self, sample, previous):
+        if previous is not None and sample.timestamp > previous.timestamp:
+            elapsed = sample.timestamp - previous.timestamp
+            for name, rate in self.fast_rates.items():
+                value, before = getattr(sample, name), getattr(previous, name)
+                if value is not None and before is not None and abs(value - before) / elapsed > rate:
+                    return True
+        return False
+
+    def period(self, sample, period):
+        """
+        Seconds until the next poll of sample's unit; period is the default.
+        """
+        key = (sample.port, sample.modID)
+        previous = self.previous.get(key)
+        self.previous[key] = sample
+        if self.near_limit(key, sample) or self.changing(sample, previous):
+            chosen = self.min_period  # Never backs off while a cutoff is active
+        elif sample.current is not None and abs(sample.current) < self.idle_current:
+            chosen = min(self.max_period, max(period, 2 * self.periods.get(key, period)))
+        else:
+            chosen = period
+        self.periods[key] = chosen
+        return chosen
+
 
+class UnitScheduler(object):
+    """
+    Polls every battery present on the bus, interleaving them on the shared line.
+
+    Each unit ID has its own poll period. When several units are due, the one
+    that has waited longest goes first and each gets one poll per round, so a
+    slow or failing unit cannot starve the others. One absent unit ID is probed
+    every probe_period seconds to pick up batteries added to the string, and a
+    unit that has not answered for stale_after seconds is dropped.
 
-# Start monitoring in a separate thread
-modbus_thread = threading.Thread(target=monitor_modbus, daemon=True)
-modbus_thread.start()
+    At start-up the scan stops at the first unit that answers, so it is polled
+    straight away; the rest of the range is scanned in the next round.
+    """
 
-# Initialize system
-print("System initialized. Monitoring Modbus devices...")
\ No newline at end of file
+    def __init__(self, unit_ids=UNIT_IDS, period=1.0, periods=None, stale_after=15,
+                 probe_period=10, on_samples=None, on_lost=None, session=None, adaptive=None):
+        """
+        :param period: default seconds between polls of one unit.
+        :param periods: optional dict of modID -> poll period overriding period.
+        :param adaptive: optional AdaptivePoll that picks each period from the last sample.
+        :param on_samples: called with the list of Samples from each round.
+        :param on_lost: called with a modID when that unit is dropped.
+        :param session: ModbusSession of the bus to poll, the default session if None.
+        """
+        self.session = session or bus_session
+        self.unit_ids = list(unit_ids)
+        self.period = period
+        self.periods = periods or {}
+        self.stale_after = stale_after
+        self.probe_period = probe_period
+        self.on_samples = on_samples
+        self.on_lost = on_lost
+        self.adaptive = adaptive
+        self.due = {}  # modID -> monotonic time of its next poll
+        self.last_seen = {}  # modID -> monotonic time of its last good sample
+        self.latest = {}  # modID -> newest Sample
+        self.next_probe = 0.0
+        self.probe_index = 0
+        self.unscanned = []  # Unit IDs left over from the start-up scan
+
+    def add_unit(self, modID, now):
+        if modID not in self.due:
+            log.info("Found unit, starting to poll it", modID=modID, port=self.session.port)
+        self.due[modID] = now
+        self.last_seen[modID] = now
+
+    def drop_unit(self, modID):
+        log.warning("No new data, dropping unit", modID=modID, port=self.session.port, seconds=self.stale_after)
+        del self.due[modID]
+        del self.last_seen[modID]
+        self.latest.pop(modID, None)
+        if self.on_lost:
+            self.on_lost(modID)
+
+    def probe(self, now):
+        """
+        Look for batteries that are not being polled yet.
+        With no unit known the range is scanned up to the first unit that
+        answers, and the rest of it on the next call; otherwise one absent
+        unit ID is probed so discovery takes one slot per round.
+        """
+        absent = [modID for modID in self.unit_ids if modID not in self.due]
+        if not absent:
+            return
+        if not self.due:
+            for i, modID in enumerate(absent):
+                answered = probe_unit(modID, self.session)
+                if answered is None:
+                    break  # Link is down, the session is backing off
+                if answered:
+                    self.add_unit(modID, now)
+                    self.unscanned = absent[i + 1:]
+                    break
+        elif self.unscanned:
+            for modID in discover_units(self.unscanned, self.session):
+                self.add_unit(modID, now)
+            self.unscanned = []
+        else:
+            modID = absent[self.probe_index % len(absent)]
+            self.probe_index += 1
+            if probe_unit(modID, self.session):
+                self.add_unit(modID, now)
+        if self.unscanned:
+            self.next_probe = time.monotonic()
+        else:
+            self.next_probe = time.monotonic() + (self.probe_period if self.due else 5)
+
+    def run_once(self):
+        """
+        Run one scheduling round. Returns the Samples it produced.
+        """
+        now = time.monotonic()
+        if now >= self.next_probe:
+            self.probe(now)
+            now = time.monotonic()
+
+        due = sorted((when, modID) for modID, when in self.due.items() if when <= now)
+        if not due:
+            wake = min(list(self.due.values()) + [self.next_probe])
+            time.sleep(max(0.0, wake - now))
+            return []
+
+        samples = []
+        for when, modID in due:
+            voltage, temp, current, capacity, _ = read_input_registers(modID, self.session)
+            polled = time.monotonic()
+            period = self.periods.get(modID, self.period)
+            # Keep the unit on its own grid, but never schedule into the past
+            self.due[modID] = max(when + period, polled)
+            if all(value is None for value in (voltage, temp, current, capacity)):
+                if polled - self.last_seen[modID] > self.stale_after:
+                    self.drop_unit(modID)
+                continue
+            self.last_seen[modID] = polled
+            sample = Sample(voltage, temp, current, capacity, modID, time.time(), self.session.port)
+            if self.adaptive:
+                self.due[modID] = max(when + self.adaptive.period(sample, period), polled)
+            self.latest[modID] = sample
+            samples.append(sample)
+
+        if samples and self.on_samples:
+            self.on_samples(samples)
+        return samples
+
+    def run(self):
+        while True:
+            self.run_once()
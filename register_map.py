@@ -0,0 +1,137 @@
+import struct
+
+# Read planner limits
+MAX_GAP = 16  # Unwanted registers allowed inside one block before it is split
+MAX_COUNT = 125  # Most registers one read_input_registers request may return
+
+# Register type -> (struct code, register count)
+TYPES = {
+    'uint16': ('H', 1),
+    'int16': ('h', 1),
+    'uint32': ('I', 2),
+    'int32': ('i', 2),
+    'float32': ('f', 2),
+}
+
+# Word order of 32-bit values -> struct byte order to pack the registers in.
+# 'big' has the high word first; 'little' has the low word first.
+WORD_ORDERS = {
+    'big': '>',
+    'little': '<',
+}
+
+
+def plan_reads(wanted, max_gap=MAX_GAP, max_count=MAX_COUNT):
+    """
+    Merge the wanted register ranges into as few read blocks as possible.
+    Two ranges share a block when at most max_gap unwanted registers lie
+    between them and the block stays within max_count registers.
+
+    :param wanted: dict of name -> (address, count).
+    :return: list of [start, count, [(name, offset, count), ...]] blocks.
+    """
+    blocks = []
+    for name, (address, count) in sorted(wanted.items(), key=lambda item: item[1][0]):
+        if blocks:
+            block = blocks[-1]
+            end = block[0] + block[1]
+            new_end = max(end, address + count)
+            if address - end <= max_gap and new_end - block[0] <= max_count:
+                block[1] = new_end - block[0]
+                block[2].append((name, address - block[0], count))
+                continue
+        blocks.append([address, count, [(name, 0, count)]])
+    return blocks
+
+
+class BlockDecoder(object):
+    """
+    Decodes every field of one read block. The registers are packed to
+    bytes with one precompiled Struct per word order in use, and all fields
+    of that word order are unpacked with one more, skipping the registers
+    between them as padding.
+    """
+
+    def __init__(self, start, count, fields):
+        """
+        :param fields: list of (name, offset in the block, type, word order, divisor).
+        """
+        self.start = start
+        self.count = count
+        self.names = []
+        self.parts = []  # (pack Struct, unpack Struct, divisors)
+        # Checked over all fields, since fields of different word orders are decoded apart
+        end = 0
+        for name, offset, type_name, _, _ in sorted(fields, key=lambda field: field[1]):
+            if offset < end:
+                raise ValueError("Register {} overlaps the field before it".format(name))
+            end = offset + TYPES[type_name][1]
+        # 16-bit values read the same in either word order, so they join the first part
+        orders = [order for order in WORD_ORDERS
+                  if any(field[3] == order and TYPES[field[2]][1] == 2 for field in fields)] or ['big']
+        for word_order in orders:
+            part = sorted((field for field in fields
+                           if (field[3] if TYPES[field[2]][1] == 2 else orders[0]) == word_order),
+                          key=lambda field: field[1])
+            layout = WORD_ORDERS[word_order]
+            position = 0
+            for name, offset, type_name, _, _ in part:
+                code, size = TYPES[type_name]
+                layout += 'x' * (2 * (offset - position)) + code
+                position = offset + size
+            self.names.extend(field[0] for field in part)
+            self.parts.append((struct.Struct(WORD_ORDERS[word_order] + 'H' * count),
+                               struct.Struct(layout),
+                               [field[4] for field in part]))
+
+    def decode(self, registers):
+        """
+        Return the scaled field values of this block, in the order of names.
+        """
+        values = []
+        for pack, unpack, divisors in self.parts:
+            raw = pack.pack(*registers[:self.count])
+            # Divide rather than multiply by the reciprocal, which rounds differently
+            values.extend([value / divisor if divisor != 1 else value
+                           for value, divisor in zip(unpack.unpack_from(raw), divisors)])
+        return values
+
+
+class RegisterMap(object):
+    """
+    Declarative description of the registers to read and how to decode them.
+
+    Each field is (name, address, type, word order, divisor): type is one of
+    TYPES, word order 'big' (high word first) or 'little', and the decoded
+    value is divided by divisor (1 leaves it as read). The map is compiled once into a read plan
+    and one BlockDecoder per read block, so decoding a poll costs a couple
+    of struct calls per block however many registers it holds.
+    """
+
+    def __init__(self, fields, max_gap=MAX_GAP, max_count=MAX_COUNT):
+        self.fields = {}
+        for name, address, type_name, word_order, divisor in fields:
+            if type_name not in TYPES:
+                raise ValueError("Unknown register type {!r} for {}".format(type_name, name))
+            if word_order not in WORD_ORDERS:
+                raise ValueError("Unknown word order {!r} for {}".format(word_order, name))
+            self.fields[name] = (address, type_name, word_order, divisor)
+        wanted = dict((name, (address, TYPES[type_name][1]))
+                      for name, (address, type_name, _, _) in self.fields.items())
+        self.plan = plan_reads(wanted, max_gap, max_count)
+        self.decoders = [BlockDecoder(start, count,
+                                      [(name, offset) + self.fields[name][1:] for name, offset, _ in block])
+                         for start, count, block in self.plan]
+
+    def decode(self, blocks):
+        """
+        Decode the registers of each read block (None for a block that
+        failed) into a dict of name -> value, None where unread.
+        """
+        values = {}
+        for decoder, registers in zip(self.decoders, blocks):
+            if registers and len(registers) >= decoder.count:
+                values.update(zip(decoder.names, decoder.decode(registers)))
+            else:
+                values.update(dict.fromkeys(decoder.names))
+        return values
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+import metrics
+from logs import get_logger
+
+# RelayCape LEDs under sysfs; point RELAY_ROOT at a temp directory to test without hardware
+RELAY_ROOT = '/sys/class/leds'
+
+# Relay number -> LED name under RELAY_ROOT
+RELAYS = {
+    1: 'relay-jp1',
+    2: 'relay-jp2',
+}
+
+log = get_logger('relay')
+
+relay_writes = metrics.counter('bms_relay_writes_total', "State changes written to a relay.", ['relay'])
+relay_write_seconds = metrics.histogram('bms_relay_write_seconds', "Time of one relay sysfs write.", ['relay'])
+
+
+class Relay(object):
+    """
+    One RelayCape relay, driven through its sysfs brightness file.
+
+    The file is opened once and kept open. The last commanded state is
+    cached and set() only writes when the state changes, so callers may
+    command the same state on every sample without touching sysfs. The
+    time of each write is kept in last_latency and max_latency (seconds).
+    If a write fails the file is closed and the state forgotten, so the
+    next set() tries again; the same error is only logged once.
+
+    While the relay is held (see hold()) 'on' is refused, so a timed cycle
+    cannot switch back on what a safety cutoff switched off. The check and
+    the write share the relay's lock, so no 'on' slips in after the hold.
+    """
+
+    def __init__(self, number, root=RELAY_ROOT):
+        self.number = number
+        self.path = os.path.join(root, RELAYS[number], 'brightness')
+        self.fd = None
+        self.state = None  # Last state written, None until the first write succeeds
+        self.writes = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.error = None  # Last error logged
+        self.held = False  # Refuse 'on' while a safety cutoff holds the relay off
+        self.lock = threading.Lock()
+
+    def set(self, state):
+        """
+        Command the relay 'on' or 'off'. Returns True if the relay file
+        was written, False if the relay was already in that state, is held
+        off, or the write failed.
+        """
+        if state not in ('on', 'off'):
+            raise ValueError("Invalid state. Use 'on' or 'off'.")
+        with self.lock:
+            if state == self.state or (state == 'on' and self.held):
+                return False
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_WRONLY)
+                start = time.perf_counter()
+                os.pwrite(self.fd, b'1' if state == 'on' else b'0', 0)
+                latency = time.perf_counter() - start
+            except PermissionError:
+                return self.failed("Permission denied: Please run the script with appropriate permissions.")
+            except FileNotFoundError:
+                return self.failed("File not found. Ensure the RelayCape is properly connected.")
+            except OSError as e:
+                return self.failed("Relay write failed: {}".format(e))
+            self.state = state
+            self.error = None
+            self.writes += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            relay_writes.labels(self.number).inc()
+            relay_write_seconds.labels(self.number).observe(latency)
+        log.info("Relay switched", relay=self.number, state=state, ms=round(latency * 1000, 3))
+        return True
+
+    def failed(self, message):
+        if message != self.error:
+            log.error(message, relay=self.number, path=self.path)
+            self.error = message
+        self.close()
+        return False
+
+    def hold(self, held):
+        """
+        Refuse 'on' commands (held=True) or accept them again (held=False).
+        Holding does not switch the relay; the caller commands 'off' after.
+        """
+        with self.lock:
+            changed = held != self.held
+            self.held = held
+        if changed:
+            log.info("Relay held off" if held else "Relay released", relay=self.number)
+
+    def on(self):
+        return self.set('on')
+
+    def off(self):
+        return self.set('off')
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+        self.state = None
+
+
+# One Relay object per relay, so every caller shares the cached state
+relays = {}
+relays_lock = threading.Lock()
+
+
+def shared_relay(number, root=None):
+    """
+    Return the process-wide Relay for a relay number, creating it on first
+    use (under root, RELAY_ROOT by default).
+    """
+    with relays_lock:
+        relay = relays.get(number)
+        if relay is None:
+            relay = relays[number] = Relay(number, root or RELAY_ROOT)
+        return relay
@@ -0,0 +1,175 @@
+import operator
+import threading
+import time
+import metrics
+from logs import get_logger
+from relay import shared_relay
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+class Rule(object):
+    """
+    One safety cutoff: trips when field op threshold holds for debounce
+    consecutive samples of a unit, and clears once the value has moved
+    hysteresis past the threshold for debounce consecutive samples.
+    While tripped, every sample of that unit commands relay to state; on
+    clearing, clear_state (if any) is commanded once.
+    """
+
+    def __init__(self, name, field, op, threshold, hysteresis=0.0, debounce=1,
+                 relay=2, state='off', clear_state=None):
+        if op not in OPERATORS:
+            raise ValueError("Invalid operator {!r} in rule {}".format(op, name))
+        self.name = name
+        self.field = field
+        self.op = op
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.relay = relay
+        self.state = state
+        self.clear_state = clear_state
+        self.compare = OPERATORS[op]
+
+    def tripped(self, value):
+        return self.compare(value, self.threshold)
+
+    def cleared(self, value):
+        if self.op in ('>', '>='):
+            return value < self.threshold - self.hysteresis
+        return value > self.threshold + self.hysteresis
+
+    def __repr__(self):
+        return "Rule({!r}: {} {} {})".format(self.name, self.field, self.op, self.threshold)
+
+
+log = get_logger('safety')
+
+evaluation_seconds = metrics.histogram('bms_safety_evaluation_seconds',
+                                       "Time to evaluate the safety rules on one sample.")
+trips = metrics.counter('bms_safety_trips_total', "Safety rules tripped.", ['rule'])
+
+# Cutoffs that switch the charge/discharge relay off
+SAFETY_RULES = [
+    Rule('over temperature', 'temp', '>', 45, hysteresis=2, debounce=1),
+    Rule('fully charged', 'capacity', '>=', 93, hysteresis=3, debounce=2),
+    Rule('deeply discharged', 'capacity', '<=', 23, hysteresis=3, debounce=2),
+]
+
+
+class SafetyEngine(object):
+    """
+    Evaluates the safety rules on every sample. Subscribe it to the
+    acquisition hub so it runs on the acquisition thread, with or without
+    the GUI; the path from a decoded sample to the relay write is then a
+    few comparisons and, on a state change, one sysfs write.
+
+    While any rule on a relay is active, on any unit, the relay is held
+    (Relay.hold) so nothing else can switch it on; active(relay) tells
+    which rules hold it.
+
+    Timing is kept per evaluation (evaluations, eval_total, eval_max) and
+    from sample acquisition to relay command (action_max, seconds); a
+    summary is logged every report_interval seconds.
+    """
+
+    def __init__(self, rules=SAFETY_RULES, relay=shared_relay, report_interval=600):
+        self.rules = list(rules)
+        self.rule_relays = dict((rule.name, rule.relay) for rule in self.rules)
+        self.relay = relay  # relay number -> Relay
+        self.report_interval = report_interval
+        self.status = {}  # (rule name, port, modID) -> [active, consecutive count]
+        self.lock = threading.Lock()
+        self.evaluations = 0
+        self.eval_total = 0.0
+        self.eval_max = 0.0
+        self.action_max = 0.0
+        self.trips = 0
+        self.last_report = time.monotonic()
+
+    def __call__(self, sample):
+        self.evaluate(sample)
+
+    def evaluate(self, sample):
+        """
+        Apply the rules to one sample. Returns the names of the rules
+        active for its unit. Units are told apart by port and modID, since
+        batteries on two buses may share a unit ID.
+        """
+        start = time.perf_counter()
+        port, modID = sample.port, sample.modID
+        active_rules = []
+        commands = []
+        changed = set()  # Relays whose rules tripped or cleared
+        with self.lock:
+            for rule in self.rules:
+                value = getattr(sample, rule.field)
+                if value is None:
+                    continue  # No reading; keep the rule as it was
+                status = self.status.setdefault((rule.name, port, modID), [False, 0])
+                if not status[0]:
+                    status[1] = status[1] + 1 if rule.tripped(value) else 0
+                    if status[1] >= rule.debounce:
+                        status[:] = [True, 0]
+                        changed.add(rule.relay)
+                        self.trips += 1
+                        trips.labels(rule.name).inc()
+                        log.warning("Safety rule tripped", rule=rule.name, port=port, modID=modID, field=rule.field,
+                                    value=value)
+                else:
+                    status[1] = status[1] + 1 if rule.cleared(value) else 0
+                    if status[1] >= rule.debounce:
+                        status[:] = [False, 0]
+                        changed.add(rule.relay)
+                        log.info("Safety rule cleared", rule=rule.name, port=port, modID=modID, field=rule.field,
+                                 value=value)
+                        if rule.clear_state is not None:
+                            commands.insert(0, (rule.relay, rule.clear_state))
+                if status[0]:
+                    active_rules.append(rule.name)
+                    commands.append((rule.relay, rule.state))
+
+            # Hold before switching off, so no 'on' from elsewhere can land in between
+            for relay in changed:
+                self.relay(relay).hold(bool(self.holding(relay)))
+            # Clearing actions go first so an active cutoff always has the last word
+            for relay, state in commands:
+                self.relay(relay).set(state)
+            if commands and sample.timestamp is not None:
+                self.action_max = max(self.action_max, time.time() - sample.timestamp)
+
+            elapsed = time.perf_counter() - start
+            self.evaluations += 1
+            self.eval_total += elapsed
+            self.eval_max = max(self.eval_max, elapsed)
+            evaluation_seconds.observe(elapsed)
+        if time.monotonic() - self.last_report >= self.report_interval:
+            self.last_report = time.monotonic()
+            log.info("Safety rule timing", **self.stats())
+        return active_rules
+
+    def active(self, relay):
+        """
+        Names of the rules, on any unit, that hold relay off.
+        """
+        with self.lock:
+            return self.holding(relay)
+
+    def holding(self, relay):
+        return sorted(set(name for (name, port, modID), status in self.status.items()
+                          if status[0] and self.rule_relays[name] == relay))
+
+    def stats(self):
+        return {
+            'evaluations': self.evaluations,
+            'mean_ms': round(1000 * self.eval_total / max(1, self.evaluations), 3),
+            'max_ms': round(1000 * self.eval_max, 3),
+            'trips': self.trips,
+            'max_sample_to_relay_ms': round(1000 * self.action_max, 1),
+        }
@@ -0,0 +1,258 @@
+import argparse
+import bisect
+import glob
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from modID_1 import Sample
+
+# Where the on-device history is kept, one file per day
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+KEEP_DAYS = 7
+
+# File header: magic, format version, record size, record count
+header = struct.Struct('<8sIIQ')
+HEADER_SIZE = 64
+MAGIC = b'BMSLOG\x00\x01'
+
+# timestamp, voltage, temp, current, capacity, unit ID (padded to 48 bytes)
+record = struct.Struct('<dddddH6x')
+
+# One sparse index entry per this many records
+INDEX_EVERY = 1024
+
+
+class SampleFile(object):
+    """
+    One append-only file of fixed-size sample records, accessed through mmap.
+
+    The file grows in chunks of grow_records records and the record count is
+    kept in the header. A sparse index of every INDEX_EVERY-th timestamp is
+    rebuilt on open with one read per entry, so finding the start of a time
+    range is two binary searches and never a scan. Records are assumed to be
+    appended in time order.
+    """
+
+    def __init__(self, path, grow_records=400000):
+        self.path = path
+        self.grow_records = grow_records
+        self.lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE
+        self.file = open(path, 'a+b')
+        if new:
+            self.file.truncate(HEADER_SIZE + grow_records * record.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if new:
+            header.pack_into(self.map, 0, MAGIC, 1, record.size, 0)
+        magic, version, size, self.count = header.unpack_from(self.map, 0)
+        if magic != MAGIC or size != record.size:
+            raise ValueError("{} is not a sample log".format(path))
+        # After a crash the header may count records whose page never reached the disk
+        while self.count and self.timestamp(self.count - 1) == 0:
+            self.count -= 1
+        self.index = [self.timestamp(i) for i in range(0, self.count, INDEX_EVERY)]
+
+    def timestamp(self, i):
+        return struct.unpack_from('<d', self.map, HEADER_SIZE + i * record.size)[0]
+
+    def append(self, timestamp, voltage, temp, current, capacity, modID):
+        with self.lock:
+            offset = HEADER_SIZE + self.count * record.size
+            if offset + record.size > len(self.map):
+                self.map.resize(len(self.map) + self.grow_records * record.size)
+            nan = float('nan')
+            record.pack_into(self.map, offset, timestamp,
+                             nan if voltage is None else voltage,
+                             nan if temp is None else temp,
+                             nan if current is None else current,
+                             nan if capacity is None else capacity,
+                             modID)
+            if self.count % INDEX_EVERY == 0:
+                self.index.append(timestamp)
+            self.count += 1
+            header.pack_into(self.map, 0, MAGIC, 1, record.size, self.count)
+
+    def find(self, timestamp):
+        """
+        Index of the first record at or after timestamp.
+        """
+        block = max(0, bisect.bisect_left(self.index, timestamp) - 1)
+        low = block * INDEX_EVERY
+        high = min(self.count, low + 2 * INDEX_EVERY)
+        while low < high:
+            mid = (low + high) // 2
+            if self.timestamp(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def records(self, start, end):
+        """
+        Zero-copy memoryview of records start <= i < end. Release it when
+        done; the file cannot grow while a view is held.
+        """
+        return memoryview(self.map)[HEADER_SIZE + start * record.size:HEADER_SIZE + end * record.size]
+
+    def view(self, start_time, end_time):
+        """
+        Zero-copy memoryview of the records with start_time <= timestamp < end_time.
+        """
+        return self.records(self.find(start_time), self.find(end_time))
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def decode(view, port=None):
+    """
+    Turn a view of raw records into Samples. NaN values become None.
+    """
+    for timestamp, voltage, temp, current, capacity, modID in record.iter_unpack(view):
+        yield Sample(None if voltage != voltage else voltage,
+                     None if temp != temp else temp,
+                     None if current != current else current,
+                     None if capacity != capacity else capacity,
+                     modID, timestamp, port)
+
+
+class SampleLog(object):
+    """
+    Days of battery history on the device, one SampleFile per UTC day.
+    Files older than keep_days are deleted when a new day starts.
+    """
+
+    def __init__(self, directory=LOG_DIR, keep_days=KEEP_DAYS, flush_interval=10.0):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.files = {}  # day -> SampleFile
+        self.current_day = None
+        os.makedirs(directory, exist_ok=True)
+
+    def day_path(self, day):
+        return os.path.join(self.directory, 'samples-{}.log'.format(day))
+
+    def open_day(self, day):
+        sample_file = self.files.get(day)
+        if sample_file is None:
+            sample_file = self.files[day] = SampleFile(self.day_path(day))
+        return sample_file
+
+    def append(self, sample):
+        """
+        Acquisition hub subscriber: persist one sample.
+        """
+        voltage, temp, current, capacity, modID, timestamp = sample[:6]
+        if voltage is None and temp is None and current is None and capacity is None:
+            return  # The unit went away, nothing to store
+        day = time.strftime('%Y%m%d', time.gmtime(timestamp))
+        if day != self.current_day:
+            self.current_day = day
+            self.expire()
+        self.open_day(day).append(timestamp, voltage, temp, current, capacity, modID)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.open_day(day).flush()
+            self.last_flush = time.monotonic()
+
+    def expire(self):
+        days = sorted(os.path.basename(path)[8:16]
+                      for path in glob.glob(os.path.join(self.directory, 'samples-*.log')))
+        for day in days[:-self.keep_days]:
+            sample_file = self.files.pop(day, None)
+            if sample_file is not None:
+                sample_file.close()
+            os.remove(self.day_path(day))
+
+    def samples(self, start_time, end_time):
+        """
+        Yield the stored Samples with start_time <= timestamp < end_time, oldest first.
+        """
+        first = time.strftime('%Y%m%d', time.gmtime(start_time))
+        last = time.strftime('%Y%m%d', time.gmtime(end_time))
+        for path in sorted(glob.glob(os.path.join(self.directory, 'samples-*.log'))):
+            day = os.path.basename(path)[8:16]
+            if first <= day <= last:
+                sample_file = self.open_day(day)
+                start = sample_file.find(start_time)
+                end = sample_file.find(end_time)
+                # Decode a block at a time so no view is held while the caller works
+                for i in range(start, end, INDEX_EVERY):
+                    view = sample_file.records(i, min(end, i + INDEX_EVERY))
+                    block = list(decode(view))
+                    view.release()
+                    for sample in block:
+                        yield sample
+
+    def close(self):
+        for sample_file in self.files.values():
+            sample_file.close()
+        self.files.clear()
+
+
+def replay(samples, publish, speed=1.0):
+    """
+    Feed recorded samples to publish (e.g. AcquisitionHub.publish) with
+    their original spacing divided by speed. speed=0 replays as fast as possible.
+    """
+    start = None
+    for sample in samples:
+        if speed:
+            if start is None:
+                start = (sample.timestamp, time.monotonic())
+            delay = (sample.timestamp - start[0]) / speed - (time.monotonic() - start[1])
+            if delay > 0:
+                time.sleep(delay)
+        publish(sample)
+
+
+def parse_time(text):
+    """
+    Accept seconds since the epoch or local time as 'YYYY-MM-DD HH:MM[:SS]'.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for layout in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, layout))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid time: {}".format(text))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded battery samples.")
+    parser.add_argument('start', type=parse_time, help="start time (epoch seconds or 'YYYY-MM-DD HH:MM')")
+    parser.add_argument('end', type=parse_time, help="end time")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+    parser.add_argument('--dir', default=LOG_DIR, help="sample log directory")
+    parser.add_argument('--send', action='store_true', help="send the samples to the network receiver")
+    args = parser.parse_args(argv)
+
+    consumers = [lambda sample: print(tuple(sample[:6]))]
+    if args.send:
+        from acquisition import send_sample
+        consumers.append(send_sample)
+
+    def publish(sample):
+        for consumer in consumers:
+            consumer(sample)
+
+    log = SampleLog(args.dir)
+    replay(log.samples(args.start, args.end), publish, args.speed)
+    if args.send:
+        time.sleep(2)  # Let the sender drain its queue
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+import collections
+import fcntl
+import itertools
+import os
+import queue
+import random
+import select
+import socket
+import struct
+import termios
+import threading
+import time
+import metrics
+from logs import get_logger
+from spool import Spool
+from wire_format import encode_frame
+
+# Receiver of the telemetry stream (the socket server VM)
+# sender_ip = '172.16.29.53' Kepp the binding open for DHCP
+RECEIVER_IP = '172.16.28.29'
+RECEIVER_PORT = 12345
+
+# Store-and-forward spool for samples taken while the receiver is unreachable
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+
+# A receiver that vanishes without a reset is given up on once sent data has
+# gone unacknowledged for USER_TIMEOUT seconds, or an idle connection has
+# missed KEEPALIVE_COUNT probes; the system defaults take hours
+USER_TIMEOUT = 10
+KEEPALIVE_IDLE = 5
+KEEPALIVE_INTERVAL = 2
+KEEPALIVE_COUNT = 3
+
+# ioctl giving the bytes of a TCP socket's send queue the peer has not yet acknowledged
+SIOCOUTQ = termios.TIOCOUTQ
+
+# 'binary' sends full-precision frames (see wire_format.py), 'text' the original lines
+WIRE_FORMAT = 'text'
+
+# modID -> sequence number counter for binary frames
+sequences = {}
+
+log = get_logger('sender')
+
+send_seconds = metrics.histogram('bms_sender_send_seconds', "Time of one sendall() of a batch to the receiver.")
+connections = metrics.counter('bms_sender_connections_total', "Connections opened to the receiver.")
+connect_failures = metrics.counter('bms_sender_connect_failures_total', "Failed connection attempts to the receiver.")
+
+
+def format_message(voltage, temp, current, capacity, modID):
+    """
+    Format one sample as a text line for the socket server.
+    """
+    return "voltage={}, temp={}, current={}, capacity={}, modID={}\n".format(
+        round(voltage), round(temp), round(current), round(capacity), modID)
+
+
+def encode_sample(voltage, temp, current, capacity, modID, timestamp=None, wire_format=None):
+    """
+    Encode one sample for the socket server in the configured wire format.
+    Binary frames carry full-precision values, the acquisition timestamp and
+    a per-unit sequence number the server uses to measure loss.
+    """
+    if (wire_format or WIRE_FORMAT) == 'binary':
+        counter = sequences.setdefault(modID, itertools.count())
+        return encode_frame(modID, next(counter), timestamp or time.time(),
+                            voltage, temp, current, capacity)
+    return format_message(voltage, temp, current, capacity, modID).encode()
+
+
+class TelemetrySender(object):
+    """
+    Sends telemetry lines over one persistent TCP connection from a background thread.
+
+    send() only puts the line on a bounded queue, so the caller never waits on
+    the network. When the queue is full the drop policy decides which line is
+    lost: 'oldest' keeps the freshest data, 'newest' keeps the backlog in order.
+    If the sender falls behind, up to max_batch queued lines go out in one sendall().
+    A lost connection is reopened in the background with jittered exponential backoff.
+
+    With a spool, lines that cannot be sent are written to disk instead. After
+    reconnecting the spool is replayed in order, replay_batch records per
+    sendall() and at most catchup_rate records per second, and new lines keep
+    going to the spool behind the backlog until it is empty.
+
+    A record counts as sent once the receiver's TCP stack has acknowledged
+    it, not when sendall() returns. Until then it is kept in in_flight, and
+    when the connection is found dead (the receiver closed it, reset it, or
+    left data unacknowledged for USER_TIMEOUT seconds) the records still in
+    flight are sent again or spooled, ahead of the failed batch. Delivery is
+    therefore at least once: a record acknowledged just as the link died may
+    arrive twice.
+    """
+
+    def __init__(self, host=RECEIVER_IP, port=RECEIVER_PORT, maxsize=1000, drop='oldest',
+                 max_batch=64, timeout=5, backoff_base=1.0, backoff_max=30.0,
+                 spool=None, replay_batch=512, catchup_rate=2000):
+        if drop not in ['oldest', 'newest']:
+            raise ValueError("Invalid drop policy. Use 'oldest' or 'newest'.")
+        self.host = host
+        self.port = port
+        self.drop = drop
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.spool = spool
+        self.replay_batch = replay_batch
+        self.catchup_rate = catchup_rate
+        self.queue = queue.Queue(maxsize)
+        self.sock = None
+        self.pending = []  # Batch that failed to send, retried after reconnecting
+        self.in_flight = collections.deque()  # (stream offset of its end, record) not yet acknowledged
+        self.stream_bytes = 0  # Bytes sent on the current connection
+        self.reconnects = 0  # Consecutive failed connection attempts
+        self.sent = 0
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="telemetry sender", daemon=True)
+                self.thread.start()
+        return self
+
+    def send(self, message):
+        """
+        Queue one line (str or bytes) for sending. Never blocks.
+        Returns False if a line was dropped because the queue was full.
+        """
+        if isinstance(message, str):
+            message = message.encode()
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    return False
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def connect(self):
+        """
+        Open the connection, backing off after each failure. Returns True when connected.
+        """
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.configure(self.sock)
+            self.stream_bytes = 0
+            connections.inc()
+            log.info("Connected", host=self.host, port=self.port)
+            self.reconnects = 0
+            return True
+        except OSError as e:
+            connect_failures.inc()
+            delay = min(self.backoff_max, self.backoff_base * 2 ** self.reconnects)
+            delay = random.uniform(delay / 2, delay)
+            self.reconnects += 1
+            if self.reconnects == 1:
+                log.warning("Connection failed, retrying in the background", host=self.host, port=self.port,
+                            error=e)
+            time.sleep(delay)
+            return False
+
+    def configure(self, sock):
+        """
+        Enable keepalive and time out unacknowledged data within seconds.
+        The TCP_* options are Linux's; elsewhere the system defaults apply.
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in [('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                              ('TCP_KEEPCNT', KEEPALIVE_COUNT), ('TCP_USER_TIMEOUT', USER_TIMEOUT * 1000)]:
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def peer_closed(self):
+        """
+        True if the receiver has closed or reset the connection. The receiver
+        never sends, so a readable socket means end of stream or an error.
+        """
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def acknowledge(self):
+        """
+        Forget the in-flight records the receiver has acknowledged.
+        """
+        try:
+            unacknowledged = struct.unpack('i', fcntl.ioctl(self.sock.fileno(), SIOCOUTQ, b'\0' * 4))[0]
+        except OSError:
+            unacknowledged = 0  # No way to tell; count what the kernel took as delivered
+        acknowledged = self.stream_bytes - unacknowledged
+        while self.in_flight and self.in_flight[0][0] <= acknowledged:
+            self.in_flight.popleft()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def spill(self):
+        """
+        Move the failed batch and everything queued behind it to the spool.
+        Without a spool the failed batch is kept for the next attempt.
+        """
+        if self.spool is None:
+            return
+        records = self.pending
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self.spool.append(records)
+        self.pending = []
+
+    def transmit(self, records):
+        """
+        sendall() the records as one write. Returns False if the connection
+        failed; the records still in flight are then put back in front of
+        pending, to be sent again or spooled with it.
+        """
+        try:
+            if self.peer_closed():
+                raise ConnectionResetError("receiver closed the connection")
+            data = b''.join(records)
+            begin = time.perf_counter()
+            self.sock.sendall(data)
+            send_seconds.observe(time.perf_counter() - begin)
+            for record in records:
+                self.stream_bytes += len(record)
+                self.in_flight.append((self.stream_bytes, record))
+            self.sent += len(records)
+            self.acknowledge()
+            return True
+        except OSError as e:
+            lost = [record for _, record in self.in_flight]
+            self.in_flight.clear()
+            self.sent -= len(lost)
+            self.pending = lost + self.pending
+            log.warning("Connection lost", host=self.host, port=self.port, error=e, unacknowledged=len(lost))
+            self.close()
+            return False
+
+    def replay(self):
+        """
+        Send one batch of the spool backlog, oldest first.
+        """
+        if self.sock is None and not self.connect():
+            self.spill()
+            return
+        records, position = self.spool.read(self.replay_batch)
+        if self.transmit(records):
+            self.spool.commit(position)
+            if self.spool.empty():
+                log.info("Spool replayed, back to live streaming")
+        self.spill()  # Lines that arrived meanwhile go behind the backlog
+        time.sleep(len(records) / self.catchup_rate)
+
+    def run(self):
+        while True:
+            if self.spool is not None and not self.spool.empty():
+                self.replay()
+                continue
+            if not self.pending:
+                self.pending = self.next_batch()
+            if self.sock is None and not self.connect():
+                self.spill()
+                continue
+            if self.transmit(self.pending):
+                self.pending = []
+            else:
+                self.spill()
+
+
+# Process-wide sender, created by shared_sender()
+sender = None
+sender_lock = threading.Lock()
+
+
+def shared_sender():
+    """
+    Return the process-wide TelemetrySender, creating and starting it on the first call.
+    """
+    global sender
+    with sender_lock:
+        if sender is None:
+            sender = TelemetrySender(spool=Spool(SPOOL_DIR)).start()
+            metrics.counter('bms_sender_sent_total', "Records sent to the receiver.").set_function(
+                lambda: sender.sent)
+            metrics.counter('bms_sender_dropped_total', "Records dropped from the full send queue.").set_function(
+                lambda: sender.dropped)
+            metrics.gauge('bms_sender_queue_depth', "Records waiting to be sent.").set_function(
+                sender.queue.qsize)
+            metrics.counter('bms_spool_dropped_total', "Spooled records lost to the disk limit.").set_function(
+                lambda: sender.spool.dropped)
+        return sender
@@ -0,0 +1,233 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from logs import get_logger
+from timers import shared_timers
+
+log = get_logger('spool')
+
+# Record header: payload length and CRC32 of the payload
+record_header = struct.Struct('<II')
+
+
+class Spool(object):
+    """
+    Append-only store-and-forward spool for telemetry records.
+
+    Records go into numbered segment files in one directory. The read
+    position (segment number, byte offset) is kept in an 'offset' file that
+    is replaced atomically on commit(), so after a crash or reboot reading
+    resumes exactly after the last committed record. Each record carries a
+    CRC, and a record torn by a crash at the end of the newest segment is
+    cut off on startup. When the spool grows past max_bytes the oldest
+    segments are deleted and their records are lost.
+
+    Appended records are fsynced at most fsync_interval seconds later, by a
+    timer on scheduler (shared_timers() by default) if no later append does
+    it first. The directory is fsynced after files are created, replaced or
+    deleted, so the offset file and segment list survive a power cut too.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, segment_bytes=1024 * 1024,
+                 fsync_interval=1.0, scheduler=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.scheduler = scheduler
+        self.last_fsync = 0.0
+        self.sync_timer = None  # Pending fsync of the newest appends
+        self.lock = threading.Lock()  # Guards the writer against the sync timer
+        self.dropped = 0  # Records lost to the disk limit
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                               if name.endswith('.spool'))
+        self.read_position = self.load_offset()
+        if not self.segments:
+            self.segments = [self.read_position[0]]
+        self.repair(self.segments[-1])
+        # Segments older than the committed offset were fully sent before the crash
+        for seq in [seq for seq in self.segments if seq < self.read_position[0]]:
+            self.remove_segment(seq)
+        if self.read_position[0] not in self.segments:
+            self.read_position = (self.segments[0], 0)
+        seq, offset = self.read_position
+        self.read_position = (seq, min(offset, os.path.getsize(self.segment_path(seq))))
+        self.writer = open(self.segment_path(self.segments[-1]), 'ab')
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, '{:08d}.spool'.format(seq))
+
+    def load_offset(self):
+        try:
+            with open(os.path.join(self.directory, 'offset')) as offset_file:
+                seq, offset = offset_file.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def repair(self, seq):
+        """
+        Truncate a segment after its last complete, valid record.
+        """
+        path = self.segment_path(seq)
+        if not os.path.exists(path):
+            open(path, 'ab').close()
+            return
+        with open(path, 'r+b') as segment:
+            data = segment.read()
+            good = 0
+            while good + record_header.size <= len(data):
+                length, crc = record_header.unpack_from(data, good)
+                end = good + record_header.size + length
+                if end > len(data) or zlib.crc32(data[good + record_header.size:end]) != crc:
+                    break
+                good = end
+            if good < len(data):
+                log.warning("Dropping a torn record", bytes=len(data) - good, path=path)
+                segment.truncate(good)
+
+    def remove_segment(self, seq):
+        try:
+            os.remove(self.segment_path(seq))
+        except OSError:
+            pass
+        self.segments.remove(seq)
+
+    def append(self, records):
+        """
+        Append a list of bytes records. They survive a crash once fsynced,
+        which happens at most fsync_interval seconds later.
+        """
+        buf = bytearray()
+        for record in records:
+            buf += record_header.pack(len(record), zlib.crc32(record))
+            buf += record
+        with self.lock:
+            self.writer.write(buf)
+            self.writer.flush()
+            wait = self.last_fsync + self.fsync_interval - time.monotonic()
+            if wait <= 0:
+                self.fsync()
+            elif self.sync_timer is None:
+                self.sync_timer = (self.scheduler or shared_timers()).schedule(wait, self.sync)
+
+            if self.writer.tell() >= self.segment_bytes:
+                self.roll()
+        self.enforce_limit()
+
+    def fsync(self):
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        os.fsync(self.writer.fileno())
+        self.last_fsync = time.monotonic()
+
+    def sync(self):
+        """
+        fsync the records appended since the last fsync. Runs on the timer
+        append() sets when it leaves records unsynced.
+        """
+        with self.lock:
+            self.sync_timer = None
+            if not self.writer.closed:
+                self.fsync()
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def roll(self):
+        self.fsync()
+        self.writer.close()
+        seq = self.segments[-1] + 1
+        self.segments.append(seq)
+        self.writer = open(self.segment_path(seq), 'ab')
+        self.sync_directory()
+
+    def enforce_limit(self):
+        while len(self.segments) > 1 and self.size() > self.max_bytes:
+            seq = self.segments[0]
+            lost = self.count_records(seq, self.read_position[1] if seq == self.read_position[0] else 0)
+            self.dropped += lost
+            log.warning("Spool full, dropping the oldest records", records=lost)
+            self.remove_segment(seq)
+            self.read_position = (self.segments[0], 0)
+            self.commit(self.read_position)
+
+    def count_records(self, seq, offset=0):
+        with open(self.segment_path(seq), 'rb') as segment:
+            segment.seek(offset)
+            data = segment.read()
+        count = pos = 0
+        while pos + record_header.size <= len(data):
+            pos += record_header.size + record_header.unpack_from(data, pos)[0]
+            count += 1
+        return count
+
+    def size(self):
+        return sum(os.path.getsize(self.segment_path(seq)) for seq in self.segments)
+
+    def empty(self):
+        return (self.read_position[0] == self.segments[-1]
+                and self.read_position[1] >= self.writer.tell())
+
+    def read(self, max_records, position=None):
+        """
+        Read up to max_records records (all if None) from position, by
+        default the committed read position. Returns (records, next_position);
+        pass next_position to commit() once the records are delivered.
+        """
+        seq, offset = position or self.read_position
+        records = []
+        chunk = 64 * 1024
+        while max_records is None or len(records) < max_records:
+            with open(self.segment_path(seq), 'rb') as segment:
+                segment.seek(offset)
+                data = segment.read(chunk)
+            pos = 0
+            while pos + record_header.size <= len(data) and (max_records is None or len(records) < max_records):
+                length, crc = record_header.unpack_from(data, pos)
+                end = pos + record_header.size + length
+                if end > len(data):
+                    break
+                records.append(data[pos + record_header.size:end])
+                pos = end
+            offset += pos
+            if max_records is not None and len(records) >= max_records:
+                break
+            if len(data) == chunk:
+                if pos == 0:
+                    chunk *= 2  # One record bigger than the chunk
+                continue  # More of this segment to read
+            later = [s for s in self.segments if s > seq]
+            if not later:
+                break
+            seq, offset = later[0], 0
+        return records, (seq, offset)
+
+    def commit(self, position):
+        """
+        Persist the read position atomically and delete fully sent segments.
+        """
+        path = os.path.join(self.directory, 'offset')
+        with open(path + '.tmp', 'w') as offset_file:
+            offset_file.write("{} {}\n".format(*position))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(path + '.tmp', path)
+        self.read_position = position
+        for seq in [seq for seq in self.segments if seq < position[0]]:
+            self.remove_segment(seq)
+        self.sync_directory()
+
+    def close(self):
+        with self.lock:
+            self.fsync()
+            self.writer.close()
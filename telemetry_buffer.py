@@ -0,0 +1,187 @@
+import math
+import threading
+import time
+from array import array
+
+# Stored per sample, in this order
+FIELDS = ('timestamp', 'voltage', 'temp', 'current', 'capacity')
+
+
+class SampleRing(object):
+    """
+    Fixed-capacity history of one battery, stored column-wise in typed
+    double arrays rather than as tuples, so memory stays flat however long
+    the poller runs (8 bytes per field per sample).
+
+    append() is O(1) and overwrites the oldest sample once full. Timestamps
+    increase along the ring, so a time window is found by binary search.
+    There is one writer (the poller) and readers never take a lock: they
+    take the ring's position once from a version counter, and drop any rows
+    the writer may have overwritten while they were copying.
+    """
+
+    def __init__(self, capacity=86400):
+        self.capacity = capacity
+        self.columns = dict((name, array('d', bytes(8 * capacity))) for name in FIELDS)
+        self.head = 0  # Index the next sample is written to
+        self.count = 0
+        self.version = 0  # Bumped on every append
+
+    def append(self, timestamp, voltage, temp, current, capacity):
+        """
+        Store one sample. None values are stored as NaN.
+        """
+        head = self.head
+        columns = self.columns
+        columns['timestamp'][head] = timestamp
+        columns['voltage'][head] = math.nan if voltage is None else voltage
+        columns['temp'][head] = math.nan if temp is None else temp
+        columns['current'][head] = math.nan if current is None else current
+        columns['capacity'][head] = math.nan if capacity is None else capacity
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self.version += 1
+
+    def __len__(self):
+        return self.count
+
+    def index(self, i, head, count):
+        """
+        Array index of the i-th oldest of count samples ending before head.
+        """
+        return (head - count + i) % self.capacity
+
+    def slice(self, name, start, stop, head, count):
+        """
+        Values of one field for the i-th oldest samples, start <= i < stop,
+        of the count samples ending before head.
+        """
+        column = self.columns[name]
+        first = self.index(start, head, count)
+        if first + (stop - start) <= self.capacity:
+            return column[first:first + stop - start]
+        return column[first:] + column[:(first + stop - start) % self.capacity]
+
+    def find(self, timestamp, head, count):
+        """
+        Logical index of the first sample at or after timestamp.
+        """
+        times = self.columns['timestamp']
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            if times[self.index(mid, head, count)] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def window(self, seconds=None, now=None, fields=FIELDS):
+        """
+        Return a dict of field -> array of the samples from the last
+        seconds (all of them if None), oldest first.
+        """
+        if seconds is None:
+            return self.copy(fields, lambda head, count: 0)
+        since = (now or time.time()) - seconds
+        return self.copy(fields, lambda head, count: self.find(since, head, count))
+
+    def last(self, n, fields=FIELDS):
+        """
+        Return a dict of field -> array of the newest n samples.
+        """
+        return self.copy(fields, lambda head, count: max(0, count - n))
+
+    def copy(self, fields, first):
+        """
+        Copy the samples from logical index first(head, count) to the newest.
+
+        head and count are taken once, from the version (the writer bumps it
+        last), so every column is copied from the same rows. The oldest rows
+        the writer may have overwritten during the copy are left out.
+        """
+        version = self.version
+        head, count = version % self.capacity, min(version, self.capacity)
+        start = first(head, count)
+        result = dict((name, self.slice(name, start, count, head, count)) for name in fields)
+        # The writer first fills free slots, then overwrites the oldest samples;
+        # one more append may be half written, so count it as well
+        overwritten = self.version - version + 1 - (self.capacity - count)
+        if overwritten > start:
+            for name in fields:
+                del result[name][:overwritten - start]
+        return result
+
+    def stats(self, name, seconds=None, now=None):
+        """
+        (min, max, mean) of one field over the window, ignoring missing
+        values. None if there is no data.
+        """
+        values = [value for value in self.window(seconds, now, (name,))[name] if value == value]
+        if not values:
+            return None
+        return min(values), max(values), math.fsum(values) / len(values)
+
+    def rate(self, name, seconds=None, now=None):
+        """
+        Rate of change of one field in units per second over the window,
+        from a least-squares fit. None with fewer than two samples.
+        """
+        data = self.window(seconds, now, ('timestamp', name))
+        points = [(t, value) for t, value in zip(data['timestamp'], data[name]) if value == value]
+        if len(points) < 2:
+            return None
+        t0 = points[0][0]
+        n = len(points)
+        mean_t = math.fsum(t - t0 for t, _ in points) / n
+        mean_v = math.fsum(value for _, value in points) / n
+        num = math.fsum((t - t0 - mean_t) * (value - mean_v) for t, value in points)
+        den = math.fsum((t - t0 - mean_t) ** 2 for t, _ in points)
+        return num / den if den else None
+
+    def integral(self, name, seconds=None, now=None):
+        """
+        Time integral of one field over the window by the trapezoid rule, in
+        units x seconds. For 'current' divide by 3600 to get amp-hours
+        (coulomb counting). Gaps with a missing value are skipped.
+        """
+        data = self.window(seconds, now, ('timestamp', name))
+        times, values = data['timestamp'], data[name]
+        total = 0.0
+        for i in range(1, len(times)):
+            if values[i] == values[i] and values[i - 1] == values[i - 1]:
+                total += (times[i] - times[i - 1]) * (values[i] + values[i - 1]) / 2
+        return total
+
+
+class TelemetryStore(object):
+    """
+    A SampleRing per battery, filled from acquisition hub samples. Batteries
+    are told apart by port and unit ID, since two buses may reuse an ID.
+    """
+
+    def __init__(self, capacity=86400):
+        self.capacity = capacity
+        self.rings = {}  # (port, modID) -> SampleRing
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        """
+        Acquisition hub subscriber: store one sample.
+        """
+        voltage, temp, current, capacity, modID, timestamp, port = sample[:7]
+        if voltage is None and temp is None and current is None and capacity is None:
+            return  # The unit went away, nothing to store
+        key = (port, modID)
+        ring = self.rings.get(key)
+        if ring is None:
+            with self.lock:
+                ring = self.rings.setdefault(key, SampleRing(self.capacity))
+        ring.append(timestamp, voltage, temp, current, capacity)
+
+    def get(self, port, modID):
+        """
+        Return the SampleRing of a unit, or None if nothing was stored for it.
+        """
+        return self.rings.get((port, modID))
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bms_simulator import BmsSimulator  # noqa: E402
+
+# Pseudo-terminals take 8N1 framing; a short timeout keeps absent units cheap
+PTY_SESSION = {'parity': 'N', 'bytesize': 8, 'timeout': 0.2}
+
+
+@pytest.fixture
+def simulator():
+    """
+    Factory for BmsSimulators on pseudo-terminals, closed after the test.
+    """
+    simulators = []
+
+    def make(unit_ids=(1,), **options):
+        simulators.append(BmsSimulator(unit_ids, **options))
+        return simulators[-1]
+
+    yield make
+    for simulator in simulators:
+        simulator.close()
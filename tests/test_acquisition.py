@@ -0,0 +1,92 @@
+import queue
+import time
+
+import pytest
+
+from acquisition import BusWorker
+from bms_simulator import default_values
+from conftest import PTY_SESSION
+
+
+def collect(samples, until, timeout=10.0):
+    """
+    Take samples off the queue until until(sample) is true; return them all.
+    """
+    taken = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            sample = samples.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        taken.append(sample)
+        if until(sample):
+            return taken
+    pytest.fail("condition not met within {} s; got {}".format(timeout, taken[-5:]))
+
+
+@pytest.fixture
+def worker():
+    workers = []
+
+    def make(simulator, **scheduler_options):
+        samples = queue.Queue()
+        options = dict({'unit_ids': [1, 2, 3], 'period': 0.05}, **scheduler_options)
+        workers.append(BusWorker(simulator.port, samples, PTY_SESSION, options))
+        workers[-1].start()
+        return samples
+
+    yield make
+    for bus_worker in workers:
+        bus_worker.stop()
+    for bus_worker in workers:
+        bus_worker.join(5)
+
+
+def test_polls_every_unit_present(simulator, worker):
+    bus = simulator([1, 3])
+    samples = worker(bus)
+    seen = {}
+
+    def both_seen(sample):
+        seen.setdefault(sample.modID, sample)
+        return len(seen) == 2
+
+    collect(samples, both_seen)
+    assert sorted(seen) == [1, 3]
+    for modID, sample in seen.items():
+        expected = default_values(modID)
+        assert sample.port == bus.port
+        assert sample.voltage == round(expected['voltage'], 2)
+        assert sample.temp == expected['temp']
+        assert sample.current == expected['current']
+        assert sample.capacity == expected['capacity']
+
+
+def test_first_sample_does_not_wait_for_absent_units(simulator, worker):
+    # Units 2 and 3 are absent and each costs a timeout; unit 1 must not wait on them
+    bus = simulator([1])
+    start = time.monotonic()
+    samples = worker(bus)
+    collect(samples, lambda sample: sample.modID == 1)
+    assert time.monotonic() - start < PTY_SESSION['timeout']
+
+
+def test_reports_a_unit_that_goes_away(simulator, worker):
+    bus = simulator([1, 2])
+    samples = worker(bus, stale_after=0.5)
+    collect(samples, lambda sample: sample.modID == 2)
+    bus.unit_ids.discard(2)
+    lost = collect(samples, lambda sample: sample.modID == 2 and sample.voltage is None)[-1]
+    assert lost[:4] == (None, None, None, None)
+    assert lost.port == bus.port
+
+
+def test_recovers_after_the_bus_goes_silent(simulator, worker):
+    bus = simulator([1])
+    samples = worker(bus)
+    collect(samples, lambda sample: sample.modID == 1)
+    bus.silence(1.0)
+    silence_end = time.time() + 1.0
+    sample = collect(samples, lambda sample: sample.voltage is not None and sample.timestamp > silence_end)[-1]
+    assert sample.modID == 1
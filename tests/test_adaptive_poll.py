@@ -0,0 +1,43 @@
+import pytest
+
+from modID_1 import AdaptivePoll, Sample
+
+
+def periods(values, field, current=0.0, default=3.0, **options):
+    """
+    Poll periods chosen for one idle unit reporting values of field, one per second.
+    """
+    adaptive = AdaptivePoll(**options)
+    chosen = []
+    for second, value in enumerate(values):
+        fields = dict({'voltage': 52.0, 'temp': 25.0, 'current': current, 'capacity': 50.0}, **{field: value})
+        sample = Sample(fields['voltage'], fields['temp'], fields['current'], fields['capacity'], 1,
+                        float(second), '/dev/ttyUSB0')
+        chosen.append(adaptive.period(sample, default))
+    return chosen
+
+
+@pytest.mark.parametrize('field, value', [
+    ('temp', 50.0),  # Over temperature
+    ('temp', 80.0),  # Far past the threshold
+    ('capacity', 97.0),  # Fully charged
+    ('capacity', 100.0),
+    ('capacity', 15.0),  # Deeply discharged
+    ('capacity', 0.0),
+])
+def test_past_a_threshold_polls_fast_while_idle(field, value):
+    assert periods([value] * 4, field) == [1.0] * 4
+
+
+def test_near_a_threshold_polls_fast():
+    assert periods([43.0] * 3, 'temp') == [1.0] * 3
+
+
+def test_idle_backs_off_away_from_the_thresholds():
+    assert periods([30.0] * 4, 'temp') == [6.0, 10.0, 10.0, 10.0]
+
+
+def test_stays_fast_until_cleared_past_the_hysteresis():
+    # Over temperature trips above 45 and clears below 43; no margin or rates, to see the rule alone
+    chosen = periods([30.0, 50.0, 44.0, 43.5, 42.5, 42.5], 'temp', margins={}, fast_rates={})
+    assert chosen == [6.0, 1.0, 1.0, 1.0, 3.0, 6.0]
@@ -0,0 +1,26 @@
+import io
+
+from logs import LogWriter, WARNING, format_record
+
+
+def test_format_record_quotes_values_that_need_it():
+    line = format_record(0.0, WARNING, 'modID_1', "Modbus link down", {'port': '/dev/ttyUSB0', 'reason': 'no answer'})
+    assert line == ('time=1970-01-01T00:00:00.000Z level=warning logger=modID_1 msg="Modbus link down" '
+                    'port=/dev/ttyUSB0 reason="no answer"\n')
+
+
+def test_repeats_past_the_burst_are_summarised_per_window():
+    writer = LogWriter(stream=io.StringIO(), burst=2, window=60)
+    lines = ''.join(writer.write(t, WARNING, 'sender', "Connection lost", {}) for t in range(70)).splitlines()
+    assert len(lines) == 5  # Two records, the first window's summary, two records
+    assert 'suppressed=58' in lines[2]
+    writer.windows['sender', "Connection lost"][0] = -1000  # Let the second window end
+    assert 'suppressed=8' in writer.expire()
+
+
+def test_a_full_queue_drops_and_counts():
+    writer = LogWriter(stream=io.StringIO(), maxsize=2)
+    for _ in range(5):
+        writer.submit(WARNING, 'test', "message", {})
+    assert writer.dropped == 3
+    assert 'dropped=3' in writer.expire()
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from conftest import PTY_SESSION
+from modID_1 import ModbusSession, poll_map, read_values
+
+
+@pytest.fixture
+def silent_port():
+    """
+    A serial port that opens but where nothing ever answers.
+    """
+    master, slave = os.openpty()
+    yield os.ttyname(slave)
+    os.close(slave)
+    os.close(master)
+
+
+def test_backoff_grows_while_the_port_opens_but_nothing_answers(silent_port):
+    session = ModbusSession(silent_port, backoff_base=0.01, **PTY_SESSION)
+    for _ in range(3 * session.max_failures):
+        session.read_input_registers(0, unit=1)
+    assert session.reconnects == 3
+    session.close()
+
+
+def test_backoff_resets_after_an_answer(simulator):
+    bus = simulator([1])
+    session = ModbusSession(bus.port, backoff_base=0.01, **PTY_SESSION)
+    for _ in range(session.max_failures):
+        session.read_input_registers(0, unit=2)  # Absent unit
+    assert session.reconnects == 1
+    assert not session.read_input_registers(0, unit=1).isError()
+    assert session.reconnects == 0
+    session.close()
+
+
+def test_a_quiet_unit_costs_one_timeout_and_keeps_the_link_up(simulator):
+    bus = simulator([1])
+    session = ModbusSession(bus.port, **PTY_SESSION)
+    transactions = []
+    read = session.read_input_registers
+
+    def counted(*args, **kwargs):
+        transactions.append(kwargs['unit'])
+        return read(*args, **kwargs)
+
+    session.read_input_registers = counted
+    assert len(poll_map.plan) > 1
+
+    for _ in range(2 * session.max_failures):
+        assert read_values(poll_map, 1, session)['voltage'] is not None
+        assert set(read_values(poll_map, 2, session).values()) == {None}
+    assert transactions.count(2) == 2 * session.max_failures  # One block each, the rest skipped
+    assert session.reconnects == 0  # Unit 1 kept answering, so the link never went down
+    session.close()
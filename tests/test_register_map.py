@@ -0,0 +1,69 @@
+import struct
+
+import pytest
+
+from register_map import BlockDecoder, RegisterMap, plan_reads
+
+
+def words(code, value, word_order):
+    """
+    The registers holding value packed with struct code, in word_order.
+    """
+    high, low = struct.unpack('>HH', struct.pack('>' + code, value))
+    return [high, low] if word_order == 'big' else [low, high]
+
+
+def test_plan_merges_near_ranges_and_splits_far_ones():
+    plan = plan_reads({'a': (0, 1), 'b': (2, 2), 'c': (100, 1)}, max_gap=16)
+    assert plan == [[0, 4, [('a', 0, 1), ('b', 2, 2)]], [100, 1, [('c', 0, 1)]]]
+
+
+@pytest.mark.parametrize('type_name, code, value', [
+    ('int32', 'i', -123456),
+    ('uint32', 'I', 0x12345678),
+    ('float32', 'f', 1.5),
+])
+@pytest.mark.parametrize('word_order', ['big', 'little'])
+def test_32_bit_word_orders(type_name, code, value, word_order):
+    registers = RegisterMap([('value', 0, type_name, word_order, 1)])
+    assert registers.decode([words(code, value, word_order)]) == {'value': value}
+
+
+def test_16_and_32_bit_fields_of_both_word_orders_in_one_block():
+    registers = RegisterMap([
+        ('voltage', 0, 'uint16', 'big', 1000),
+        ('current', 1, 'int32', 'big', 1000),
+        ('temp', 3, 'int16', 'little', 1),
+        ('energy', 5, 'uint32', 'little', 10),  # Register 4 is not wanted
+        ('capacity', 7, 'float32', 'little', 1),
+    ])
+    assert len(registers.plan) == 1
+    block = [52125] + words('i', -1250, 'big') + [(-3) & 0xFFFF, 0xDEAD] + words('I', 70001, 'little') + \
+        words('f', 57.5, 'little')
+    assert registers.decode([block]) == {'voltage': 52.125, 'current': -1.25, 'temp': -3, 'energy': 7000.1,
+                                         'capacity': 57.5}
+
+
+def test_scale_divides_like_the_old_decoder():
+    registers = RegisterMap([('voltage', 0, 'uint16', 'big', 1000)])
+    for raw in (1, 333, 52001, 65535):
+        assert registers.decode([[raw]])['voltage'] == raw / 1000
+
+
+def test_a_failed_or_short_block_decodes_to_none():
+    registers = RegisterMap([('a', 0, 'uint16', 'big', 1), ('b', 1, 'int32', 'big', 1),
+                             ('c', 100, 'int16', 'big', 1)])
+    assert registers.decode([None, [7]]) == {'a': None, 'b': None, 'c': 7}
+    assert registers.decode([[1, 2], [7]]) == {'a': None, 'b': None, 'c': 7}
+
+
+@pytest.mark.parametrize('second', [
+    ('b', 1, 'uint16', 'big', 1),
+    ('b', 1, 'uint32', 'big', 1),
+    ('b', 1, 'uint32', 'little', 1),  # Decoded in another part, still the same registers
+])
+def test_overlapping_fields_are_rejected(second):
+    with pytest.raises(ValueError):
+        RegisterMap([('a', 0, 'uint32', 'big', 1), second])
+    with pytest.raises(ValueError):
+        BlockDecoder(0, 3, [('a', 0, 'uint32', 'big', 1), (second[0], 1) + second[2:]])
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import relay
+from relay import Relay, RELAYS
+
+
+@pytest.fixture
+def root(tmp_path):
+    """
+    A sysfs-like relay root with a brightness file per relay.
+    """
+    for name in RELAYS.values():
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'brightness').write_text('0')
+    return tmp_path
+
+
+def brightness(root, number):
+    return (root / RELAYS[number] / 'brightness').read_text()
+
+
+def test_writes_only_on_a_state_change(root):
+    switch = Relay(2, str(root))
+    assert switch.set('on') is True
+    assert brightness(root, 2) == '1'
+    assert switch.set('on') is False
+    assert switch.writes == 1
+    assert switch.off() is True
+    assert brightness(root, 2) == '0'
+    assert switch.writes == 2
+    assert switch.max_latency >= switch.last_latency > 0
+    switch.close()
+
+
+def test_relays_are_independent(root):
+    first, second = Relay(1, str(root)), Relay(2, str(root))
+    first.on()
+    assert brightness(root, 1) == '1'
+    assert brightness(root, 2) == '0'
+    first.close()
+    second.close()
+
+
+def test_missing_relay_fails_and_retries(root):
+    os.remove(str(root / RELAYS[2] / 'brightness'))
+    switch = Relay(2, str(root))
+    assert switch.set('on') is False
+    assert switch.error is not None
+    assert switch.state is None  # Not cached, so the next set() tries again
+    (root / RELAYS[2] / 'brightness').write_text('0')
+    assert switch.set('on') is True
+    assert switch.error is None
+    assert brightness(root, 2) == '1'
+    switch.close()
+
+
+def test_rejects_an_unknown_state(root):
+    with pytest.raises(ValueError):
+        Relay(2, str(root)).set('maybe')
+
+
+def test_shared_relay_is_one_object_per_number(root, monkeypatch):
+    monkeypatch.setattr(relay, 'relays', {})
+    assert relay.shared_relay(2, str(root)) is relay.shared_relay(2)
+    assert relay.shared_relay(1, str(root)) is not relay.shared_relay(2)
+
+
+def test_a_held_relay_refuses_on(root):
+    switch = Relay(2, str(root))
+    switch.on()
+    switch.hold(True)
+    assert switch.off() is True
+    assert switch.on() is False
+    assert brightness(root, 2) == '0'
+    switch.hold(False)
+    assert switch.on() is True
+    switch.close()
@@ -0,0 +1,94 @@
+import time
+
+from modID_1 import Sample
+from relay import Relay, RELAYS
+from safety import Rule, SafetyEngine
+from timers import TimerScheduler, DutyCycle
+
+
+class FakeRelay(object):
+
+    def __init__(self):
+        self.commands = []
+        self.held = False
+
+    def set(self, state):
+        self.commands.append(state)
+
+    def hold(self, held):
+        self.held = held
+
+
+def engine(*rules):
+    relay = FakeRelay()
+    return SafetyEngine(rules, relay=lambda number: relay), relay
+
+
+def sample(port='/dev/ttyUSB0', modID=1, **values):
+    fields = dict({'voltage': 52.0, 'temp': 25.0, 'current': -1.0, 'capacity': 50.0}, **values)
+    return Sample(fields['voltage'], fields['temp'], fields['current'], fields['capacity'], modID, 0.0, port)
+
+
+def test_trips_after_debounce_samples():
+    safety, relay = engine(Rule('full', 'capacity', '>=', 93, hysteresis=3, debounce=2))
+    assert safety.evaluate(sample(capacity=95)) == []
+    assert safety.evaluate(sample(capacity=50)) == []  # The run is broken, counting restarts
+    assert safety.evaluate(sample(capacity=95)) == []
+    assert safety.evaluate(sample(capacity=95)) == ['full']
+    assert relay.commands == ['off']
+    assert safety.trips == 1
+
+
+def test_clears_only_past_the_hysteresis():
+    safety, relay = engine(Rule('hot', 'temp', '>', 45, hysteresis=2, debounce=1, clear_state='on'))
+    assert safety.evaluate(sample(temp=46)) == ['hot']
+    assert safety.evaluate(sample(temp=44)) == ['hot']  # Below the threshold, inside the hysteresis
+    assert safety.evaluate(sample(temp=42.9)) == []
+    assert relay.commands == ['off', 'off', 'on']
+
+
+def test_missing_value_keeps_the_rule_as_it_was():
+    safety, relay = engine(Rule('hot', 'temp', '>', 45, hysteresis=2))
+    safety.evaluate(sample(temp=50))
+    assert safety.evaluate(sample(temp=None)) == []
+    assert safety.evaluate(sample(temp=44)) == ['hot']
+
+
+def test_units_on_different_buses_are_kept_apart():
+    # Same unit ID on two buses, samples interleaved
+    safety, relay = engine(Rule('full', 'capacity', '>=', 93, debounce=2))
+    for _ in range(2):
+        safety.evaluate(sample(port='/dev/ttyUSB0', capacity=95))
+        safety.evaluate(sample(port='/dev/ttyUSB1', capacity=50))
+    assert safety.trips == 1
+    assert 'off' in relay.commands
+
+
+def test_an_active_rule_holds_its_relay_on_any_unit():
+    safety, relay = engine(Rule('hot', 'temp', '>', 45, hysteresis=2))
+    safety.evaluate(sample(modID=1, temp=50))
+    safety.evaluate(sample(modID=2, temp=50))
+    assert relay.held and safety.active(2) == ['hot']
+    safety.evaluate(sample(modID=1, temp=30))
+    assert relay.held  # Unit 2 is still over temperature
+    safety.evaluate(sample(modID=2, temp=30))
+    assert not relay.held and safety.active(2) == []
+
+
+def test_a_duty_cycle_cannot_switch_on_a_held_relay(tmp_path):
+    (tmp_path / RELAYS[2]).mkdir()
+    (tmp_path / RELAYS[2] / 'brightness').write_text('0')
+    switch = Relay(2, str(tmp_path))
+    safety = SafetyEngine([Rule('hot', 'temp', '>', 45, hysteresis=2)], relay=lambda number: switch)
+    cycle = DutyCycle(TimerScheduler(), switch, 0.2, 0.05)
+
+    safety.evaluate(sample(temp=50))
+    cycle.start()
+    time.sleep(0.05)  # Inside the first on phase, 0 to 0.2 s
+    assert switch.held and (tmp_path / RELAYS[2] / 'brightness').read_text() == '0'
+
+    safety.evaluate(sample(temp=30))
+    time.sleep(0.3)  # Inside the next on phase, 0.25 to 0.45 s
+    assert not switch.held and (tmp_path / RELAYS[2] / 'brightness').read_text() == '1'
+    cycle.stop('off')
+    switch.close()
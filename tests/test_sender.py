@@ -0,0 +1,74 @@
+import socket
+import time
+
+import pytest
+
+from sender import TelemetrySender
+from spool import Spool
+
+
+def receive(conn, lines, count, timeout=5.0):
+    """
+    Read lines from conn into lines until count of them have arrived.
+    """
+    conn.settimeout(0.1)
+    buffer = b''
+    deadline = time.monotonic() + timeout
+    while len(lines) < count and time.monotonic() < deadline:
+        try:
+            data = conn.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        buffer += data
+        *complete, buffer = buffer.split(b'\n')
+        lines.extend(complete)
+    return lines
+
+
+@pytest.fixture
+def listener():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+    server.settimeout(5)
+    yield server
+    server.close()
+
+
+def test_nothing_is_lost_across_a_receiver_restart(tmp_path, listener):
+    sender = TelemetrySender(*listener.getsockname(), spool=Spool(str(tmp_path)),
+                             backoff_base=0.05, backoff_max=0.1).start()
+    for n in range(50):
+        sender.send("line {}\n".format(n))
+    conn, _ = listener.accept()
+    lines = receive(conn, [], 50)
+    conn.close()  # The receiver restarts
+    time.sleep(0.1)
+
+    for n in range(50, 200):
+        sender.send("line {}\n".format(n))
+    conn, _ = listener.accept()
+    receive(conn, lines, 200)
+    conn.close()
+    assert set(lines) == set("line {}".format(n).encode() for n in range(200))
+
+
+def test_unacknowledged_records_are_sent_again(listener):
+    # A receiver that stops reading, with a small window, leaves most records unacknowledged
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+    sender = TelemetrySender(*listener.getsockname())
+    assert sender.connect()
+    conn, _ = listener.accept()
+    records = [b'%099d\n' % n for n in range(200)]
+    assert sender.transmit(records)
+    lost = [record for _, record in sender.in_flight]
+    assert lost and lost == records[-len(lost):]
+
+    conn.close()
+    time.sleep(0.1)
+    sender.pending = [b'next\n']
+    assert not sender.transmit(sender.pending)
+    assert sender.pending == lost + [b'next\n']
+    assert sender.sent == 200 - len(lost)
@@ -0,0 +1,74 @@
+import socket
+import time
+
+import pytest
+
+from Socket_server import TelemetryServer
+from wire_format import SEQUENCE_MODULUS, encode_frame, sequence_gap
+
+
+@pytest.fixture
+def server():
+    received = []
+    telemetry = TelemetryServer('127.0.0.1', 0, on_record=lambda record, address: received.append(record))
+    telemetry.received = received
+    yield telemetry
+    telemetry.close()
+
+
+def feed(server, chunks, count):
+    """
+    Send chunks over one connection, each in its own recv, until count records have arrived.
+    """
+    client = socket.create_connection(server.address)
+    for chunk in chunks:
+        client.sendall(chunk)
+        time.sleep(0.01)  # Let each chunk arrive on its own
+        server.poll(0.1)
+    deadline = time.monotonic() + 2
+    while len(server.received) < count and time.monotonic() < deadline:
+        server.poll(0.1)
+    client.close()
+    return server.received
+
+
+def split(data, *cuts):
+    edges = [0] + list(cuts) + [len(data)]
+    return [data[start:end] for start, end in zip(edges, edges[1:])]
+
+
+def test_text_line_split_across_reads(server):
+    line = b'voltage=52, temp=25, current=-1, capacity=58, modID=2\n'
+    records = feed(server, split(line + line, 10, len(line) + 5), 2)
+    assert [record['modID'] for record in records] == [2, 2]
+    assert records[0]['voltage'] == 52.0
+
+
+def test_binary_frame_split_across_reads_between_text_lines(server):
+    line = b'voltage=52, temp=25, current=-1, capacity=58, modID=2\n'
+    # Unit 10 puts a newline byte inside the frame, which must not end it
+    binary = encode_frame(10, 7, 1000.0, 52.125, 25.5, -1.25, 58.0)
+    data = line[:20] + line[20:] + binary + line
+    records = feed(server, split(data, 20, len(line) + 3, len(line) + 20), 3)
+    assert [record['modID'] for record in records] == [2, 10, 2]
+    assert records[1]['voltage'] == 52.125 and records[1]['seq'] == 7
+    assert server.malformed == 0
+
+
+def test_counts_sequence_gaps_per_unit(server):
+    frames = [encode_frame(modID, seq, 0.0, 52.0, 25.0, -1.0, 58.0)
+              for modID, seq in [(1, 0), (2, 0), (1, 1), (1, 4), (2, 1)]]
+    feed(server, [b''.join(frames)[:50], b''.join(frames)[50:]], 5)
+    assert server.lost == 2  # Unit 1 skipped 2 and 3
+
+
+@pytest.mark.parametrize('last, seq, gap', [
+    (5, 6, 0),
+    (5, 9, 3),
+    (SEQUENCE_MODULUS - 1, 0, 0),  # Wrapped
+    (SEQUENCE_MODULUS - 2, 1, 2),  # Wrapped with SEQUENCE_MODULUS - 1 and 0 missing
+    (1000, 0, 0),  # Sender restarted
+    (5, 5, 0),  # Repeated frame
+])
+def test_sequence_gap(last, seq, gap):
+    assert sequence_gap(last, seq) == gap
@@ -0,0 +1,94 @@
+import os
+import stat
+import time
+
+from spool import Spool
+from timers import TimerScheduler
+
+
+def reopen(spool, directory, **options):
+    spool.close()
+    return Spool(directory, **options)
+
+
+def test_resumes_after_the_last_committed_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'one', b'two', b'three'])
+    records, position = spool.read(2)
+    assert records == [b'one', b'two']
+    spool.commit(position)
+
+    spool = reopen(spool, str(tmp_path))
+    assert spool.read(None)[0] == [b'three']
+    spool.close()
+
+
+def test_cuts_off_a_torn_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'complete'])
+    path = spool.segment_path(spool.segments[-1])
+    spool.close()
+    with open(path, 'ab') as segment:
+        segment.write(b'\x10\x00\x00\x00\x00\x00')  # A header and part of a record, as a crash leaves it
+    torn_size = os.path.getsize(path)
+
+    spool = Spool(str(tmp_path))
+    assert os.path.getsize(path) < torn_size
+    spool.append([b'after'])
+    assert spool.read(None)[0] == [b'complete', b'after']
+    spool.close()
+
+
+def test_cuts_off_a_corrupt_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'good', b'flipped'])
+    path = spool.segment_path(spool.segments[-1])
+    spool.close()
+    with open(path, 'r+b') as segment:
+        segment.seek(-1, os.SEEK_END)
+        segment.write(b'X')  # Fails the CRC
+
+    spool = Spool(str(tmp_path))
+    assert spool.read(None)[0] == [b'good']
+    spool.close()
+
+
+def test_reads_across_segments_and_deletes_sent_ones(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    records = [bytes([65 + i]) * 20 for i in range(10)]
+    spool.append(records[:5])
+    spool.append(records[5:])
+    assert len(spool.segments) > 1
+    read, position = spool.read(None)
+    assert read == records
+    spool.commit(position)
+    assert spool.segments == [position[0]]
+    assert spool.empty()
+    spool.close()
+
+
+def test_drops_the_oldest_segments_past_the_limit(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=200, segment_bytes=64)
+    for i in range(20):
+        spool.append([bytes([65 + i]) * 20])
+    assert spool.dropped > 0
+    assert spool.size() <= 200 + 64
+    read = spool.read(None)[0]
+    assert read == [bytes([65 + i]) * 20 for i in range(20 - len(read), 20)]
+    spool.close()
+
+
+def test_fsyncs_unsynced_appends_on_a_timer(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(stat.S_ISDIR(os.fstat(fd).st_mode)) or fsync(fd))
+    spool = Spool(str(tmp_path), fsync_interval=0.05, scheduler=TimerScheduler())
+    spool.append([b'one'])
+    spool.append([b'two'])
+    assert synced == [False]  # The second append is inside the interval
+    time.sleep(0.2)
+    assert synced == [False, False]  # The timer caught it up
+
+    spool.commit(spool.read(None)[1])
+    assert synced[-1] is True  # The directory, after the offset file was replaced
+    spool.close()
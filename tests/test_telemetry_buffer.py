@@ -0,0 +1,64 @@
+import math
+
+from modID_1 import Sample
+from telemetry_buffer import SampleRing, TelemetryStore
+
+
+def filled(capacity, count):
+    # Row i has timestamp i and voltage i + 1, so a shifted column shows
+    ring = SampleRing(capacity)
+    for i in range(count):
+        ring.append(i, i + 1, 25, -1, 50)
+    return ring
+
+
+def test_last_and_window_across_the_wrap():
+    ring = filled(8, 13)
+    assert len(ring) == 8
+    assert list(ring.last(3)['timestamp']) == [10, 11, 12]
+    data = ring.window(4.5, now=12)
+    assert list(data['timestamp']) == [8, 9, 10, 11, 12]
+    assert list(data['voltage']) == [9, 10, 11, 12, 13]
+
+
+def test_missing_values_are_nan():
+    ring = SampleRing(4)
+    ring.append(1, None, 25, None, 50)
+    data = ring.last(1)
+    assert math.isnan(data['voltage'][0])
+    assert math.isnan(data['current'][0])
+    assert data['temp'][0] == 25
+
+
+def test_copy_stays_row_aligned_when_the_writer_appends_mid_copy():
+    ring = filled(8, 10)
+    slice_columns = ring.slice
+
+    def slice_and_append(name, *args):
+        column = slice_columns(name, *args)
+        if name == 'timestamp':
+            ring.append(10, 11, 25, -1, 50)  # Lands between two column copies
+        return column
+
+    ring.slice = slice_and_append
+    for data in (ring.last(5, ('timestamp', 'voltage')), ring.window(None, fields=('timestamp', 'voltage'))):
+        assert len(data['timestamp']) == len(data['voltage']) > 0
+        assert [v - t for t, v in zip(data['timestamp'], data['voltage'])] == [1] * len(data['voltage'])
+
+
+def test_rate_and_integral():
+    ring = SampleRing(100)
+    for t in range(11):
+        ring.append(t, 50 + 0.5 * t, 25, 2.0, 50)
+    assert abs(ring.rate('voltage') - 0.5) < 1e-9
+    assert abs(ring.integral('current') - 20.0) < 1e-9
+
+
+def test_store_keeps_units_on_different_buses_apart():
+    store = TelemetryStore(capacity=10)
+    store.add(Sample(52.0, 25, -1, 50, 1, 100.0, '/dev/ttyUSB0'))
+    store.add(Sample(48.0, 25, -1, 50, 1, 100.5, '/dev/ttyUSB1'))
+    store.add(Sample(None, None, None, None, 1, 101.0, '/dev/ttyUSB0'))  # Unit lost, not stored
+    assert list(store.get('/dev/ttyUSB0', 1).last(5)['voltage']) == [52.0]
+    assert list(store.get('/dev/ttyUSB1', 1).last(5)['voltage']) == [48.0]
+    assert store.get('/dev/ttyUSB2', 1) is None
@@ -0,0 +1,185 @@
+import heapq
+import itertools
+import threading
+import time
+from logs import get_logger
+
+log = get_logger('timers')
+
+
+class Timer(object):
+    """
+    Handle of one scheduled call. cancel() takes effect immediately: a
+    cancelled timer never runs, however far away it was due.
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler(object):
+    """
+    Runs timed calls on one thread, whatever the number of timers.
+
+    Timers are kept in a heap ordered by due time (time.monotonic()); the
+    thread sleeps on a condition until the earliest one is due and is woken
+    whenever an earlier timer is added. Cancelled timers are left in the
+    heap and skipped when they come up. Callbacks run on the scheduler
+    thread and must return quickly.
+    """
+
+    def __init__(self):
+        self.heap = []  # (when, sequence, Timer)
+        self.sequence = itertools.count()  # Keeps equal due times in order
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="timers", daemon=True)
+                self.thread.start()
+        return self
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) after delay seconds. Returns its Timer.
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (timer.when, next(self.sequence), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()  # Due before whatever the thread waits for
+        self.start()
+        return timer
+
+    def reschedule(self, timer, delay):
+        """
+        Cancel timer and schedule its call again after delay seconds.
+        Returns the new Timer.
+        """
+        timer.cancel()
+        return self.schedule(delay, timer.callback, *timer.args)
+
+    def pending(self):
+        with self.condition:
+            return sum(1 for _, _, timer in self.heap if not timer.cancelled)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.condition.wait(wait)
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.error("Timer callback error", callback=getattr(timer.callback, '__name__', timer.callback),
+                          error=e)
+
+
+class DutyCycle(object):
+    """
+    Switches a relay on for on_seconds, then off for off_seconds, repeating
+    until stop(). Every switch runs as a timer on the scheduler, so a cycle
+    costs no thread and stops at once. While a safety cutoff holds the relay
+    (Relay.hold) an on phase leaves it off; the cycle keeps its timing and
+    switches on again at the first on phase after the cutoff clears.
+    """
+
+    def __init__(self, scheduler, relay, on_seconds, off_seconds):
+        self.scheduler = scheduler
+        self.relay = relay
+        self.on_seconds = on_seconds
+        self.off_seconds = off_seconds
+        self.lock = threading.Lock()
+        self.timer = None  # Pending switch while running
+        self.generation = 0  # Bumped on start/stop so a switch already under way is dropped
+        self.state = None  # Phase being run: 'on' or 'off'
+        self.phase_start = None
+
+    @property
+    def running(self):
+        return self.timer is not None
+
+    def start(self):
+        """
+        (Re)start the cycle with the on phase, now.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.generation += 1
+            self.timer = self.scheduler.schedule(0, self.switch, 'on', self.generation)
+
+    def stop(self, state='off'):
+        """
+        Cancel the cycle and leave the relay in state (None leaves it as is).
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.generation += 1
+            self.state = None
+        if state is not None:
+            self.relay.set(state)
+
+    def set_period(self, on_seconds, off_seconds):
+        """
+        Change the duty cycle. A running phase ends after its new length,
+        counted from when it began.
+        """
+        with self.lock:
+            self.on_seconds = on_seconds
+            self.off_seconds = off_seconds
+            if self.timer is not None and self.state is not None:
+                left = self.phase_start + self.length(self.state) - time.monotonic()
+                self.timer = self.scheduler.reschedule(self.timer, max(0, left))
+
+    def length(self, state):
+        return self.on_seconds if state == 'on' else self.off_seconds
+
+    def switch(self, state, generation):
+        with self.lock:
+            if generation != self.generation:
+                return  # Stopped or restarted while this switch was being started
+            self.relay.set(state)
+            if state == 'on' and self.relay.held:
+                log.warning("Duty cycle on phase held off by a safety cutoff", relay=self.relay.number)
+            else:
+                log.info("Duty cycle switched", relay=self.relay.number, state=state)
+            self.state = state
+            self.phase_start = time.monotonic()
+            self.timer = self.scheduler.schedule(self.length(state), self.switch,
+                                                 'off' if state == 'on' else 'on', generation)
+
+
+# Process-wide scheduler for timed relay actions, created by shared_timers()
+timers = None
+timers_lock = threading.Lock()
+
+
+def shared_timers():
+    """
+    Return the process-wide TimerScheduler, starting it on the first call.
+    """
+    global timers
+    with timers_lock:
+        if timers is None:
+            timers = TimerScheduler().start()
+        return timers
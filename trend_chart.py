@@ -0,0 +1,237 @@
+import collections
+import time
+import tkinter as tk
+
+# Field -> (strip label, line colour), top to bottom
+TREND_SERIES = [
+    ('voltage', "Voltage (V)", "red"),
+    ('current', "Current (A)", "yellow"),
+    ('temp', "Temperature °C", "orange"),
+    ('capacity', "Capacity %", "light green"),
+]
+
+# Spans a tap on the chart cycles through, in seconds
+TREND_SPANS = [600, 3600, 6 * 3600, 24 * 3600]
+
+# Most samples fed to the downsamplers per refresh; a longer backlog (the
+# first view of a span) is caught up over several short Tk callbacks
+CATCH_UP_SAMPLES = 2000
+
+
+def largest_triangle(ts, values, anchor, average):
+    """
+    Index of the point (ts[i], values[i]) forming the largest triangle with
+    the points anchor and average, the step Largest-Triangle-Three-Buckets
+    downsampling uses to keep peaks and dips.
+    """
+    ax, ay = anchor
+    avg_x, avg_y = average
+    max_area = -1.0
+    chosen = 0
+    for i in range(len(ts)):
+        area = abs((ax - avg_x) * (values[i] - ay) - (ax - ts[i]) * (avg_y - ay))
+        if area > max_area:
+            max_area = area
+            chosen = i
+    return chosen
+
+
+class Downsampler(object):
+    """
+    Incremental Largest-Triangle-Three-Buckets downsampling of one series.
+
+    Time is cut into buckets of bucket_seconds aligned to the clock. Once
+    the bucket after it is complete, a bucket's point is chosen against the
+    previously chosen point and that next bucket's average, as in LTTB,
+    and never revisited. Only the raw samples of the last two buckets are
+    kept, so adding a sample costs the same whatever the span.
+    """
+
+    def __init__(self, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.chosen = collections.deque()  # (t, value) per finished bucket, oldest first
+        self.pending = []  # [bucket number, times, values] of the last two buckets
+        self.last_time = None
+
+    def add(self, t, value):
+        if self.last_time is not None and t <= self.last_time:
+            return  # Already seen
+        self.last_time = t
+        if value != value:
+            return  # Missing (NaN); the line is drawn across the gap
+        bucket = int(t // self.bucket_seconds)
+        if not self.pending or bucket != self.pending[-1][0]:
+            if len(self.pending) == 2:
+                self.chosen.append(self.choose(self.pending[0], self.pending[1]))
+                del self.pending[0]
+            self.pending.append([bucket, [], []])
+        self.pending[-1][1].append(t)
+        self.pending[-1][2].append(value)
+
+    def choose(self, bucket, following):
+        _, ts, values = bucket
+        if not self.chosen:
+            return ts[0], values[0]  # The first point is always kept
+        average = (sum(following[1]) / len(following[1]), sum(following[2]) / len(following[2]))
+        i = largest_triangle(ts, values, self.chosen[-1], average)
+        return ts[i], values[i]
+
+    def trim(self, start):
+        """
+        Forget chosen points older than start.
+        """
+        while len(self.chosen) > 1 and self.chosen[0][0] < start:
+            self.chosen.popleft()
+
+    def points(self, start):
+        """
+        The downsampled series from start on: the chosen points, a
+        provisional point for the bucket still waiting on its successor,
+        and the newest sample.
+        """
+        points = [point for point in self.chosen if point[0] >= start]
+        if len(self.pending) == 2:
+            points.append(self.choose(self.pending[0], self.pending[1]))
+        if self.pending:
+            ts, values = self.pending[-1][1], self.pending[-1][2]
+            points.append((ts[-1], values[-1]))
+        return points
+
+
+class TrendChart(tk.Canvas):
+    """
+    Trend panel: one horizontal strip per series showing the last span
+    seconds of a SampleRing.
+
+    Each strip owns a single line item and two text items, created once.
+    Every span keeps a Downsampler per series with about one point per
+    pixel; a refresh feeds it only the samples that arrived since the last
+    one and moves the existing line with coords(). Reading the whole window
+    only happens the first time a span is shown for a battery. Nothing is
+    redrawn if the ring has not changed since the last refresh.
+    """
+
+    def __init__(self, parent, width=740, height=320, series=TREND_SERIES, spans=TREND_SPANS,
+                 **kwargs):
+        super(TrendChart, self).__init__(parent, width=width, height=height, bg="black",
+                                         highlightthickness=0, **kwargs)
+        self.width = width
+        self.height = height
+        self.series = series
+        self.spans = spans
+        self.span = spans[0]
+        self.left = 10
+        self.right = width - 130  # Room for the value column
+        self.lines = {}  # field -> line item
+        self.texts = {}  # field -> value text item
+        self.shown = {}  # text item -> text, so unchanged text is not reconfigured
+        self.drawn = None  # (ring, version, span) of the last refresh
+        self.samplers = {}  # span -> (ring, {field: Downsampler})
+        self.catch_up = None  # Pending after() id while a backlog is being fed
+        self.draw_chart()
+        self.bind('<Button-1>', self.next_span)
+
+    def draw_chart(self):
+        self.delete("all")
+        strip = self.height / len(self.series)
+        self.span_text = self.create_text(self.left, 2, anchor="nw", fill="white",
+                                          font=("Arial", 10), text=self.span_label())
+        for i, (field, label, colour) in enumerate(self.series):
+            top = i * strip
+            self.create_line(self.left, top + strip - 1, self.right, top + strip - 1, fill="#333333")
+            self.create_text(self.right + 10, top + 14, anchor="nw", text=label, fill=colour,
+                             font=("Arial", 10))
+            self.texts[field] = self.create_text(self.right + 10, top + 32, anchor="nw", text="",
+                                                 fill="white", font=("Arial", 10))
+            self.lines[field] = self.create_line(0, 0, 0, 0, fill=colour, width=2, state="hidden")
+        self.drawn = None
+
+    def span_label(self):
+        if self.span >= 3600:
+            return "Last {:g} h (tap to change)".format(self.span / 3600)
+        return "Last {:g} min (tap to change)".format(self.span / 60)
+
+    def next_span(self, event=None):
+        self.span = self.spans[(self.spans.index(self.span) + 1) % len(self.spans)]
+        self.itemconfig(self.span_text, text=self.span_label())
+        self.drawn = None
+
+    def set_text(self, item, text):
+        if self.shown.get(item) != text:
+            self.itemconfig(item, text=text)
+            self.shown[item] = text
+
+    def refresh(self, ring, now=None):
+        """
+        Plot the last span seconds of ring, a telemetry_buffer.SampleRing
+        (or None to clear the chart).
+        """
+        if self.catch_up is not None:
+            self.after_cancel(self.catch_up)
+            self.catch_up = None
+        if ring is None:
+            for field in self.lines:
+                self.itemconfig(self.lines[field], state="hidden")
+                self.set_text(self.texts[field], "")
+            self.drawn = None
+            return
+        if self.drawn == (ring, ring.version, self.span):
+            return
+        self.drawn = (ring, ring.version, self.span)
+
+        now = now or time.time()
+        start = now - self.span
+        plot_width = self.right - self.left
+        samplers, behind = self.update_samplers(ring, now, plot_width)
+        if behind:
+            self.drawn = None
+            self.catch_up = self.after(1, self.refresh, ring)
+        strip = self.height / len(self.series)
+        for i, (field, label, colour) in enumerate(self.series):
+            points = samplers[field].points(start)
+            line = self.lines[field]
+            if len(points) < 2:
+                self.itemconfig(line, state="hidden")
+                self.set_text(self.texts[field], "")
+                continue
+            xs = [t for t, _ in points]
+            ys = [value for _, value in points]
+            low = min(ys)
+            high = max(ys)
+            if high - low < 1e-9:
+                low, high = low - 1, high + 1
+            top = i * strip + 16  # Below the strip's labels
+            scale_y = (strip - 22) / (high - low)
+            scale_x = plot_width / self.span
+            coords = []
+            for t, value in zip(xs, ys):
+                coords.append(self.left + (t - start) * scale_x)
+                coords.append(top + (high - value) * scale_y)
+            self.coords(line, coords)
+            self.itemconfig(line, state="normal")
+            self.set_text(self.texts[field], "{:.2f}\n{:.1f} - {:.1f}".format(ys[-1], min(ys), max(ys)))
+
+    def update_samplers(self, ring, now, plot_width):
+        """
+        Bring the current span's downsamplers up to date with ring, reading
+        only the samples newer than the last one they were fed, at most
+        CATCH_UP_SAMPLES of them. Returns the downsamplers and whether more
+        samples are waiting.
+        """
+        fields = [field for field, _, _ in self.series]
+        entry = self.samplers.get(self.span)
+        if entry is None or entry[0] is not ring:
+            entry = self.samplers[self.span] = (
+                ring, dict((field, Downsampler(self.span / plot_width)) for field in fields))
+            since = now - self.span
+        else:
+            since = next(iter(entry[1].values())).last_time or now - self.span
+        data = ring.window(max(0.0, now - since), now, ['timestamp'] + fields)
+        times = data['timestamp']
+        count = min(len(times), CATCH_UP_SAMPLES)
+        for field, sampler in entry[1].items():
+            values = data[field]
+            for j in range(count):
+                sampler.add(times[j], values[j])
+            sampler.trim(now - self.span)
+        return entry[1], count < len(times)
@@ -0,0 +1,48 @@
+import math
+import struct
+
+# First byte of a binary frame. Text lines are ASCII, so a byte >= 0x80
+# cannot start one and the receiver can tell the two formats apart.
+FRAME_VERSION = 0x81
+
+# version, unit ID, sequence number, acquisition timestamp, voltage, temp, current, capacity
+frame = struct.Struct('<BBIddddd')
+
+SEQUENCE_MODULUS = 2 ** 32
+
+
+def encode_frame(modID, seq, timestamp, voltage, temp, current, capacity):
+    """
+    Pack one sample into a fixed-size binary frame. None values are sent as NaN.
+    """
+    nan = math.nan
+    return frame.pack(FRAME_VERSION, modID, seq % SEQUENCE_MODULUS, timestamp,
+                      nan if voltage is None else voltage,
+                      nan if temp is None else temp,
+                      nan if current is None else current,
+                      nan if capacity is None else capacity)
+
+
+def decode_frame(buffer, offset=0):
+    """
+    Unpack the frame at offset in buffer into a record dict.
+    """
+    version, modID, seq, timestamp, voltage, temp, current, capacity = frame.unpack_from(buffer, offset)
+    return {
+        'voltage': None if voltage != voltage else voltage,  # NaN back to None
+        'temp': None if temp != temp else temp,
+        'current': None if current != current else current,
+        'capacity': None if capacity != capacity else capacity,
+        'modID': modID,
+        'seq': seq,
+        'timestamp': timestamp,
+    }
+
+
+def sequence_gap(last, seq):
+    """
+    Number of frames missing between sequence numbers last and seq.
+    A sequence that goes backwards means the sender restarted and counts as no loss.
+    """
+    gap = (seq - last - 1) % SEQUENCE_MODULUS
+    return 0 if gap >= SEQUENCE_MODULUS // 2 else gap